@@ -1,15 +1,10 @@
 import random
-from dotenv import load_dotenv
-import goodfire
-import torch.nn as nn
+import numpy as np
 
-from copy import deepcopy
-from utils import add_statistic, get_valid_move, get_top_features, get_base_api_format, display_board
+from utils import add_statistic, get_valid_move, default_backend, convert_boards_to_observations
+from prompting import prompt_builder
 from constants import MODEL
-from stable_baselines3 import PPO
-from stable_baselines3.common.policies import ActorCriticPolicy
-
-from stable_baselines3.sac import MlpPolicy, SAC
+from board import as_board, POW3, NUM_KEYS
 
 class BaseAgent():
     
@@ -24,41 +19,53 @@ class BaseAgent():
     
 class RandomAgent(BaseAgent):
     
-    def __init__(self, player):
+    def __init__(self, player, seed=None):
         super().__init__(player)
+        self.random = random.Random(seed)
         
     def act(self, state):
-        return random.choice([i for i, spot in enumerate(state) if spot not in ['X', 'O']])
+        return self.random.choice(as_board(state).legal_moves())
     
 class OptimalAgent(BaseAgent):
     
-    def __init__(self, player, move_checker):
+    def __init__(self, player, move_checker, seed=None):
         super().__init__(player)
         self.move_checker = move_checker
         
+        # Own generator, so agents stepped on different threads do not share one
+        self.random = random.Random(seed)
+        
     def act(self, state):
         optimal_moves = self.move_checker.get_optimal_moves(state, self.player)
         
         # Randomly select a move from the optimal moves
-        return random.choice(optimal_moves)
+        return self.random.choice(optimal_moves)
     
 class LLMAgent(BaseAgent):
     
-    def __init__(self, player, get_context=False):
+    def __init__(self, player, get_context=False, backend=None, move_selection='completion'):
         self.player = player
         
-        self.model = goodfire.Variant(MODEL)
+        self.backend = backend if backend is not None else default_backend
+        self.model = self.backend.variant(MODEL)
+        
+        # See TicTacToeSAE, 'sample' and 'argmax' take one request per move
+        self.move_selection = move_selection
+        self.move_distribution = None
+        self.random = random.Random()
         
         self.stats = {'top_features': {}}
         self.get_context = get_context
         
-        self.api_template = get_base_api_format()
+        # Moves waiting for feature inspection, see context.collect_context
+        self.pending_context = []
+        
+        self.prompts = prompt_builder()
         
     def act(self, state):
         
-        # Create copy of the template
-        api_format = deepcopy(self.api_template)
-        api_format['user']['content'] = self.api_template['user']['content'].format(board=display_board(state), player_type=self.player)
+        # Only the assistant message is new, the prompt messages are shared
+        api_format = self.prompts.api_format(state, self.player)
         
         # Skip punishment since this agent is not learning
         move, response = get_valid_move(self, state, api_format)
@@ -69,21 +76,38 @@ class LLMAgent(BaseAgent):
         
         api_format['assistant']['content'] = response
         
+        # Inspection is done in batches after the games so that it does not slow them down
         if self.get_context:
-            get_top_features(self, state, move, api_format)
+            self.pending_context.append({'state': tuple(state), 'move': move, 'api_format': api_format})
         
         return move
     
 class RLAgent(BaseAgent):
     
-    def __init__(self, player, test_mode=False, use_checkpoint=False):
+    def __init__(self, player, test_mode=False, use_checkpoint=False, tensorboard_log="output/tensorboard/", seed=None, checkpoint_dir=None, symmetric_replay=False):
         super().__init__(player)
         self.stats = {}
         self.test_mode = test_mode
         self.use_checkpoint = use_checkpoint
+        self.tensorboard_log = tensorboard_log
+        self.seed = seed
+        
+        # Every transition is also stored for the 7 symmetric boards, see offline.SymmetricReplayBuffer
+        self.symmetric_replay = symmetric_replay
+        
+        # Directory of an AsyncCheckpointCallback, loaded instead of the saved model when it holds a checkpoint
+        self.checkpoint_dir = checkpoint_dir
+        
+        # Deterministic action for every position key, filled by precompute_actions
+        self.action_table = None
         
     def setup_model(self, env):
         
+        # Imported here since torch is slow to import and only the RL agent needs it
+        from stable_baselines3.sac import MlpPolicy, SAC
+        from callbacks import load_checkpoint, read_manifest
+        from offline import SymmetricReplayBuffer
+        
         # Use sac algorithm
         if not self.test_mode:
             self.model = SAC(
@@ -91,17 +115,98 @@ class RLAgent(BaseAgent):
                 env,
                 verbose=1,
                 batch_size=256,
-                tensorboard_log="output/tensorboard/",
+                tensorboard_log=self.tensorboard_log,
                 device='cpu',
                 learning_rate=3e-4,
+                seed=self.seed,
+                replay_buffer_class=SymmetricReplayBuffer if self.symmetric_replay else None,
             )
         
         if self.test_mode or self.use_checkpoint:
             print("Loading trained model from disk")
-            self.model = SAC.load("output/saerl_model_load_fix.zip", env=env)
-            self.model.load_replay_buffer("output/saerl_replay_buffer_load_fix.pkl")
+            if self.checkpoint_dir is not None and read_manifest(self.checkpoint_dir) is not None:
+                self.model = load_checkpoint(self.checkpoint_dir, env, tensorboard_log=self.tensorboard_log)
+            else:
+                self.model = SAC.load("output/saerl_model_load_fix.zip", env=env)
+                self.model.load_replay_buffer("output/saerl_replay_buffer_load_fix.pkl")
+    
+    def learn_offline(self, env, transitions, gradient_steps, eval_env=None, eval_freq=1000, eval_episodes=5):
+        """
+        Trains SAC on logged transitions only, see offline.load_transitions.
+        env only provides the spaces and is never stepped. If eval_env is given, the policy is
+        played for eval_episodes games every eval_freq gradient steps, which are the only API calls.
+        """
+        from stable_baselines3.common.evaluation import evaluate_policy
+        from stable_baselines3.common.utils import configure_logger
+        from offline import build_replay_buffer
+        
+        self.setup_model(env)
+        self.model.replay_buffer = build_replay_buffer(transitions, env.observation_space, env.action_space)
+        self.model.set_logger(configure_logger(self.model.verbose, self.model.tensorboard_log, "SAC_offline"))
+        
+        steps_done = 0
+        while steps_done < gradient_steps:
+            steps = min(eval_freq, gradient_steps - steps_done)
+            self.model.train(gradient_steps=steps, batch_size=self.model.batch_size)
+            steps_done += steps
+            
+            if eval_env is not None:
+                mean_reward, std_reward = evaluate_policy(self.model, eval_env, n_eval_episodes=eval_episodes)
+                self.model.logger.record("eval/mean_reward", mean_reward)
+                self.model.logger.record("eval/std_reward", std_reward)
+            
+            self.model.logger.dump(step=steps_done)
+        
+        return self.model
+    
+    def act_batch(self, boards=None, deterministic=True, keys=None):
+        """
+        Returns the steering vectors for a batch of boards or of position keys, see
+        convert_boards_to_observations for the accepted formats. The actor is run once for the whole batch.
+        """
+        observations = convert_boards_to_observations(boards, keys=keys)
+        if self.action_table is None or not deterministic:
+            return self._run_actor(observations, deterministic)
+        
+        # Keys left out of precompute_actions are NaN in the table and go through the actor
+        actions = self.action_table[observations @ POW3]
+        missing = np.isnan(actions).any(axis=1)
+        if missing.any():
+            actions[missing] = self._run_actor(observations[missing], deterministic)
+        return actions
+    
+    def _run_actor(self, observations, deterministic):
+        import torch as th
+        
+        policy = self.model.policy
+        policy.set_training_mode(False)
+        with th.inference_mode():
+            observation_tensor, _ = policy.obs_to_tensor(observations)
+            actions = policy._predict(observation_tensor, deterministic=deterministic).cpu().numpy()
+        
+        # SAC acts in [-1, 1], the environment expects the steering bound
+        return policy.unscale_action(actions) if policy.squash_output else actions
+    
+    def precompute_actions(self, keys=None):
+        """
+        Stores the deterministic action of every position key, or only of keys, e.g. the boards
+        from evaluation.student_boards. Deterministic calls of act and act_batch then look actions
+        up instead of running the actor, other keys still run it.
+        Must be called again after the model is trained further.
+        """
+        keys = np.arange(NUM_KEYS) if keys is None else np.asarray(keys, dtype=np.int64)
+        self.action_table = None
+        
+        actions = self.act_batch(keys=keys)
+        self.action_table = np.full((NUM_KEYS, actions.shape[1]), np.nan, dtype=actions.dtype)
+        self.action_table[keys] = actions
+        return self.action_table
     
     # Used during testing
-    def act(self, state):
-        actions, _ = self.model.predict(state)
+    def act(self, state, deterministic=False):
+        if self.action_table is not None and deterministic:
+            # state is one observation, not a board in list form
+            return self.act_batch(np.asarray(state).reshape(1, 9), deterministic=True)[0]
+        
+        actions, _ = self.model.predict(state, deterministic=deterministic)
         return actions
\ No newline at end of file
@@ -0,0 +1,375 @@
+"""
+Steering backends used by the environments and agents.
+
+A backend creates variants of a model, whose feature edits are changed with set and reset,
+and serves chat completions, next token logits of the nine moves and feature inspection for
+those variants. GoodfireBackend talks to the Goodfire API, LocalBackend is a deterministic
+stand-in that runs offline.
+
+goodfire is imported on first use, so that processes which never call the API, e.g. the
+SubprocVecEnv workers before their first step, do not pay for importing it.
+"""
+import os, re, sys, time, uuid, asyncio, threading
+from types import SimpleNamespace
+import numpy as np
+
+# Tokens the model answers a move with, cell i is MOVE_TOKENS[i]
+MOVE_TOKENS = [str(move) for move in range(1, 10)]
+
+def is_rate_limit_error(error):
+    # goodfire is already imported whenever one of its errors has been raised
+    goodfire = sys.modules.get('goodfire')
+    return goodfire is not None and isinstance(error, goodfire.api.exceptions.RateLimitException)
+
+def rate_limit_error(message):
+    import goodfire
+    return goodfire.api.exceptions.RateLimitException(message)
+
+def plain_messages(messages):
+    """
+    Copies the messages into plain dicts, the prompts hand out shared read-only mappings
+    """
+    return [dict(message) for message in messages]
+
+class GoodfireBackend:
+    """
+    Args:
+        api_key: Goodfire API key, read from GOODFIRE_API_KEY (or .env) when the client is first needed if not given
+    """
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key
+        self._client = None
+        self._async_client = None
+
+    def _api_key(self):
+        if self.api_key is None:
+            import dotenv
+            dotenv.load_dotenv()
+            self.api_key = os.getenv('GOODFIRE_API_KEY')
+        return self.api_key
+
+    def __getstate__(self):
+        # Clients hold connections, every process creates its own
+        state = self.__dict__.copy()
+        state['_client'] = None
+        state['_async_client'] = None
+        return state
+
+    @property
+    def client(self):
+        # Created on the first request rather than when the backend is constructed
+        if self._client is None:
+            import goodfire
+            self._client = goodfire.Client(self._api_key())
+        return self._client
+
+    @property
+    def async_client(self):
+        # Only created when the async completion layer is used
+        if self._async_client is None:
+            import goodfire
+            self._async_client = goodfire.AsyncClient(self._api_key())
+        return self._async_client
+
+    def variant(self, model):
+        import goodfire
+        return goodfire.Variant(model)
+
+    def complete(self, model, messages, max_completion_tokens=25):
+        completion = self.client.chat.completions.create(
+            model=model,
+            messages=plain_messages(messages),
+            max_completion_tokens=max_completion_tokens
+        )
+        return completion.choices[0].message['content']
+
+    async def complete_async(self, model, messages, max_completion_tokens=25):
+        completion = await self.async_client.chat.completions.create(
+            model=model,
+            messages=plain_messages(messages),
+            max_completion_tokens=max_completion_tokens
+        )
+        return completion.choices[0].message['content']
+
+    def move_logits(self, model, messages):
+        """
+        Returns the logits of the move tokens for the first token of the answer
+        """
+        return self.client.chat.logits(plain_messages(messages), model=model, top_k=len(MOVE_TOKENS), filter_vocabulary=MOVE_TOKENS).logits
+
+    async def move_logits_async(self, model, messages):
+        response = await self.async_client.chat.logits(plain_messages(messages), model=model, top_k=len(MOVE_TOKENS), filter_vocabulary=MOVE_TOKENS)
+        return response.logits
+
+    def inspect(self, messages, model):
+        return self.client.features.inspect(plain_messages(messages), model=model)
+
+    async def inspect_async(self, messages, model):
+        return await self.async_client.features.inspect(plain_messages(messages), model=model)
+
+class LocalVariant:
+    """
+    Mirrors the parts of goodfire.Variant used by this repo
+    """
+
+    def __init__(self, base_model, random=None):
+        self.base_model = base_model
+        self.edits = {}
+        
+        # Sampling generator of this variant, see LocalBackend.variant
+        self.random = random
+
+    def set(self, feature, value):
+        self.edits[feature] = value
+
+    def clear(self, feature):
+        self.edits.pop(feature, None)
+
+    def reset(self):
+        self.edits = {}
+
+class LocalToken:
+
+    def __init__(self, token, activations):
+        self._token = token
+        self._activations = activations
+
+    def inspect(self, k=5):
+        return self._activations[:k]
+
+class LocalBackend:
+    """
+    Synthetic model whose move distribution is a function of the board and the steering vector.
+
+    Each feature has a fixed random weight per cell, so steering a feature shifts the logits of
+    the cells it is tied to. Occupied cells keep a small probability, so the agent still has to
+    learn to avoid invalid moves. Latency and rate limit errors can be simulated.
+
+    Args:
+        seed: Seeds both the feature weights and the sampling
+        num_features: Number of synthetic features exposed through self.features
+        latency: Seconds each completion takes
+        rate_limit_probability: Chance that a request fails with a rate limit error
+        garbled_probability: Chance that a completion contains no move
+        occupied_penalty: Logit penalty for occupied cells, large values make invalid moves rare
+    """
+
+    BOARD_PATTERN = re.compile(r'^[1-9XO] [1-9XO] [1-9XO]$', re.MULTILINE)
+
+    def __init__(self, seed=0, num_features=64, latency=0.0, rate_limit_probability=0.0, garbled_probability=0.0, occupied_penalty=3.0, steering_scale=10.0):
+        import goodfire
+
+        rng = np.random.default_rng(seed)
+        self.features = [goodfire.Feature(uuid.UUID(int=i + 1), f"Synthetic feature {i}", i) for i in range(num_features)]
+        self.base_logits = rng.normal(0, 1, 9)
+        self.feature_weights = rng.normal(0, steering_scale, (num_features, 9))
+        self.occupied_penalty = occupied_penalty
+
+        self.latency = latency
+        self.rate_limit_probability = rate_limit_probability
+        self.garbled_probability = garbled_probability
+        self.random = np.random.default_rng(seed)
+        self.stats = {'calls': 0, 'rate_limited': 0}
+
+        # Every variant samples from its own generator, so environments sharing the backend on
+        # different threads neither share nor race on one
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def variant(self, model):
+        with self._lock:
+            seed = self.seed_sequence.spawn(1)[0]
+        return LocalVariant(model, np.random.default_rng(seed))
+
+    def _random(self, model):
+        return model.random if getattr(model, 'random', None) is not None else self.random
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def parse_board(self, messages):
+        """
+        Reads the board from the last user message, returns a list of occupied flags
+        """
+        user_message = [message for message in messages if message['role'] == 'user'][-1]
+        rows = self.BOARD_PATTERN.findall(user_message['content'])[-3:]
+        cells = ' '.join(rows).split()
+        return [cell in ['X', 'O'] for cell in cells]
+
+    def steering(self, model):
+        steering = np.zeros(9)
+        if isinstance(model, LocalVariant):
+            for feature, value in model.edits.items():
+                steering += value * self.feature_weights[feature.index_in_sae % len(self.features)]
+        return steering
+
+    def move_distribution(self, model, messages):
+        logits = self.base_logits + self.steering(model)
+        logits = logits - self.occupied_penalty * np.array(self.parse_board(messages))
+        probabilities = np.exp(logits - logits.max())
+        return probabilities / probabilities.sum()
+
+    def _respond(self, model, messages):
+        rng = self._random(model)
+        self._count('calls')
+        if rng.random() < self.rate_limit_probability:
+            self._count('rate_limited')
+            raise rate_limit_error("Simulated rate limit")
+
+        if rng.random() < self.garbled_probability:
+            return "I am not sure"
+
+        move = rng.choice(9, p=self.move_distribution(model, messages))
+        return str(move + 1)
+
+    def complete(self, model, messages, max_completion_tokens=25):
+        time.sleep(self.latency)
+        return self._respond(model, messages)
+
+    async def complete_async(self, model, messages, max_completion_tokens=25):
+        await asyncio.sleep(self.latency)
+        return self._respond(model, messages)
+
+    def _logits(self, model, messages):
+        self._count('calls')
+        if self._random(model).random() < self.rate_limit_probability:
+            self._count('rate_limited')
+            raise rate_limit_error("Simulated rate limit")
+
+        logits = np.log(self.move_distribution(model, messages))
+        return dict(zip(MOVE_TOKENS, logits.tolist()))
+
+    def move_logits(self, model, messages):
+        time.sleep(self.latency)
+        return self._logits(model, messages)
+
+    async def move_logits_async(self, model, messages):
+        await asyncio.sleep(self.latency)
+        return self._logits(model, messages)
+
+    def inspect(self, messages, model):
+        """
+        Tokens of the assistant message, digits report the features tied most strongly to that cell
+        """
+        tokens = []
+        for token in messages[-1]['content'].split():
+            activations = []
+            if token.isdigit() and 1 <= int(token) <= 9:
+                strengths = np.abs(self.feature_weights[:, int(token) - 1])
+                activations = [
+                    SimpleNamespace(feature=self.features[i], activation=float(strengths[i]))
+                    for i in np.argsort(-strengths)
+                ]
+            tokens.append(LocalToken(token, activations))
+        return SimpleNamespace(tokens=tokens)
+
+    async def inspect_async(self, messages, model):
+        await asyncio.sleep(self.latency)
+        if self._random(model).random() < self.rate_limit_probability:
+            self._count('rate_limited')
+            raise rate_limit_error("Simulated rate limit")
+        return self.inspect(messages, model)
+
+class BudgetedBackend:
+    """
+    Wraps a backend so that at most a fixed number of requests are in flight across every
+    process holding the same semaphore, e.g. the trials of a sweep
+
+    Args:
+        backend: Backend serving the requests
+        semaphore: multiprocessing semaphore created with the global concurrency budget
+    """
+
+    def __init__(self, backend, semaphore):
+        self.backend = backend
+        self.semaphore = semaphore
+
+    def __getattr__(self, name):
+        # Everything that is not a request, e.g. variant or features, goes to the wrapped backend
+        if name.startswith('__') or name == 'backend':
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+    def complete(self, model, messages, max_completion_tokens=25):
+        with self.semaphore:
+            return self.backend.complete(model, messages, max_completion_tokens=max_completion_tokens)
+
+    async def complete_async(self, model, messages, max_completion_tokens=25):
+        # The semaphore blocks, so it is acquired off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.semaphore.acquire)
+        try:
+            return await self.backend.complete_async(model, messages, max_completion_tokens=max_completion_tokens)
+        finally:
+            self.semaphore.release()
+
+    def move_logits(self, model, messages):
+        with self.semaphore:
+            return self.backend.move_logits(model, messages)
+
+    async def move_logits_async(self, model, messages):
+        await asyncio.get_running_loop().run_in_executor(None, self.semaphore.acquire)
+        try:
+            return await self.backend.move_logits_async(model, messages)
+        finally:
+            self.semaphore.release()
+
+    def inspect(self, messages, model):
+        with self.semaphore:
+            return self.backend.inspect(messages, model)
+
+    async def inspect_async(self, messages, model):
+        await asyncio.get_running_loop().run_in_executor(None, self.semaphore.acquire)
+        try:
+            return await self.backend.inspect_async(messages, model)
+        finally:
+            self.semaphore.release()
+
+class FeatureTable:
+    """
+    Steered features stored as plain arrays. It pickles without goodfire, so the features can be
+    loaded once and sent to every worker process cheaply. The feature objects are created on
+    first use.
+    """
+
+    def __init__(self, uuids, labels, indices):
+        self.uuids = np.asarray(uuids, dtype=str)
+        self.labels = np.asarray(labels, dtype=str)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self._features = None
+
+    @classmethod
+    def from_features(cls, features):
+        features = list(features)
+        return cls(
+            [str(feature.uuid) for feature in features],
+            [feature.label for feature in features],
+            [feature.index_in_sae for feature in features],
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
+
+    def __len__(self):
+        return len(self.indices)
+
+    def features(self):
+        if self._features is None:
+            import goodfire
+            self._features = [
+                goodfire.Feature(uuid.UUID(feature_uuid), str(label), int(index))
+                for feature_uuid, label, index in zip(self.uuids, self.labels, self.indices)
+            ]
+        return self._features
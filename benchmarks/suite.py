@@ -0,0 +1,234 @@
+"""
+Throughput benchmarks for the environment, the move checker and the training loop.
+
+Run from the repository root with `python -m benchmarks`. Results are written as JSON so that
+runs on different commits can be compared.
+"""
+import argparse, contextlib, io, json, os, subprocess, sys, tempfile, time
+import numpy as np
+
+from agents import OptimalAgent, RandomAgent
+from backends import LocalBackend
+from board import Board
+from constants import TEACHER, NUM_ACTIONS_SAE
+from move_checker import MoveChecker
+from tictactoe import TicTacToeEnv, TicTacToeSAE
+from utils import convert_board_to_observation
+
+OUTPUT_DIR = 'output/benchmarks'
+
+# Seconds from a fresh interpreter to NUM_ENVS reset TicTacToeSAE workers
+STARTUP_TARGET_SECONDS = 5.0
+
+# Run in a new interpreter so that the imports are timed as well
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from main import make_sae_envs
+from agents import OptimalAgent
+from backends import LocalBackend, FeatureTable
+from constants import TEACHER, NUM_ACTIONS_SAE
+from move_checker import MoveChecker
+imported = time.perf_counter()
+move_checker = MoveChecker()
+action_features = FeatureTable.from_features(LocalBackend().features[:NUM_ACTIONS_SAE])
+env = make_sae_envs(move_checker, OptimalAgent(TEACHER, move_checker), {num_envs}, action_features=action_features)
+env.reset()
+ready = time.perf_counter()
+env.close()
+print(json.dumps({{'import_seconds': imported - start, 'envs_seconds': ready - imported}}))
+"""
+
+def summarize(latencies, total_time=None):
+    """
+    Steps per second and latency percentiles in microseconds for a list of per call timings
+    """
+    latencies = np.asarray(latencies)
+    total_time = latencies.sum() if total_time is None else total_time
+    return {
+        'calls': len(latencies),
+        'steps_per_sec': len(latencies) / total_time if total_time > 0 else None,
+        'mean_us': float(latencies.mean() * 1e6),
+        'p50_us': float(np.percentile(latencies, 50) * 1e6),
+        'p90_us': float(np.percentile(latencies, 90) * 1e6),
+        'p99_us': float(np.percentile(latencies, 99) * 1e6),
+    }
+
+def play_random_games(env, student, num_steps):
+    """
+    Steps env with student's moves and returns the latency of every step
+    """
+    latencies = []
+    state, _ = env.reset()
+    while len(latencies) < num_steps:
+        action = student.act(state) if student is not None else env.action_space.sample()
+        start = time.perf_counter()
+        state, _, done, _, _ = env.step(action)
+        latencies.append(time.perf_counter() - start)
+        if done:
+            state, _ = env.reset()
+    return latencies
+
+def sample_positions(num_positions, seed=0):
+    """
+    Random (board, player to move) pairs from games played with random moves
+    """
+    rng = np.random.default_rng(seed)
+    positions = []
+    while len(positions) < num_positions:
+        board = Board()
+        player = 'X'
+        while board.winner() is None and not board.is_full():
+            positions.append((board.copy(), player))
+            board.place(int(rng.choice(board.legal_moves())), player)
+            player = 'O' if player == 'X' else 'X'
+    return positions[:num_positions]
+
+def bench_env_step(num_steps):
+    move_checker = MoveChecker()
+    env = TicTacToeEnv(move_checker, OptimalAgent(TEACHER, move_checker))
+    return summarize(play_random_games(env, RandomAgent('O'), num_steps))
+
+def bench_move_checker(num_positions):
+    # An empty search table so the first search pass is cold
+    search_directory = tempfile.TemporaryDirectory()
+    move_checker = MoveChecker(search_table_path=os.path.join(search_directory.name, 'search_table.npy'))
+    positions = sample_positions(num_positions)
+
+    def time_calls(function):
+        latencies = []
+        for board, player in positions:
+            start = time.perf_counter()
+            function(board, player)
+            latencies.append(time.perf_counter() - start)
+        return summarize(latencies)
+
+    results = {}
+
+    # Minimax search without the table, as used before the solved table existed
+    results['search_cold'] = time_calls(move_checker.search_optimal_moves)
+    results['search_warm'] = time_calls(move_checker.search_optimal_moves)
+
+    # Table lookups, the first pass touches the memory map for the first time
+    results['table_cold'] = time_calls(MoveChecker().get_optimal_moves)
+    results['table_warm'] = time_calls(move_checker.get_optimal_moves)
+
+    # Release the memory maps before the directory is removed
+    del move_checker
+    search_directory.cleanup()
+    return results
+
+def bench_convert_board(num_positions):
+    positions = sample_positions(num_positions)
+    results = {}
+    for name, boards in [('board', [board for board, _ in positions]), ('list', [board.to_list() for board, _ in positions])]:
+        latencies = []
+        for board in boards:
+            start = time.perf_counter()
+            convert_board_to_observation(board)
+            latencies.append(time.perf_counter() - start)
+        results[name] = summarize(latencies)
+    return results
+
+def make_sae_env(latency, seed=0):
+    move_checker = MoveChecker()
+
+    # Invalid answers make get_valid_move sleep for SLEEP_TIME, which would swamp the step cost
+    backend = LocalBackend(seed=seed, latency=latency, occupied_penalty=50.0)
+    return TicTacToeSAE(move_checker, OptimalAgent(TEACHER, move_checker), backend=backend, action_features=backend.features[:NUM_ACTIONS_SAE])
+
+def bench_sae_step(num_steps, latency):
+    env = make_sae_env(latency)
+    return summarize(play_random_games(env, None, num_steps))
+
+def bench_sac_learn(num_steps, num_envs_options, latency):
+    # Imported here since torch is slow to import and only needed by this benchmark
+    from stable_baselines3 import SAC
+    from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv
+
+    results = {}
+    for vec_env_class in [DummyVecEnv, SubprocVecEnv]:
+        for num_envs in num_envs_options:
+            env = vec_env_class([lambda i=i: make_sae_env(latency, seed=i) for i in range(num_envs)])
+            model = SAC('MlpPolicy', env, learning_starts=min(100, num_steps // 2), device='cpu', verbose=0)
+
+            start = time.perf_counter()
+            model.learn(total_timesteps=num_steps)
+            elapsed = time.perf_counter() - start
+            env.close()
+
+            results[f'{vec_env_class.__name__}_{num_envs}'] = {
+                'num_envs': num_envs,
+                'timesteps': model.num_timesteps,
+                'seconds': elapsed,
+                'steps_per_sec': model.num_timesteps / elapsed,
+            }
+    return results
+
+def bench_startup(num_envs, repeats=3):
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT.format(num_envs=num_envs)], text=True)
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    totals = [run['import_seconds'] + run['envs_seconds'] for run in runs]
+    return {
+        'num_envs': num_envs,
+        'import_seconds': float(np.median([run['import_seconds'] for run in runs])),
+        'envs_seconds': float(np.median([run['envs_seconds'] for run in runs])),
+        'seconds': float(np.median(totals)),
+        'target_seconds': STARTUP_TARGET_SECONDS,
+        'within_target': bool(np.median(totals) <= STARTUP_TARGET_SECONDS),
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmarks for SAE-RL")
+    parser.add_argument('--only', nargs='+', choices=['env_step', 'move_checker', 'convert_board', 'sae_step', 'sac_learn', 'startup'], help="Run only these benchmarks")
+    parser.add_argument('--steps', type=int, default=20000, help="Steps for the environment and lookup benchmarks")
+    parser.add_argument('--sae-steps', type=int, default=200, help="Steps for the TicTacToeSAE benchmark")
+    parser.add_argument('--sac-steps', type=int, default=500, help="Timesteps for each SAC.learn run")
+    parser.add_argument('--latency', type=float, default=0.0, help="Simulated completion latency in seconds")
+    parser.add_argument('--num-envs', type=int, nargs='+', default=[1, 2, 6], help="NUM_ENVS values for the SAC benchmark")
+    parser.add_argument('--output', default=None, help="JSON file to write, defaults to output/benchmarks/<commit>.json")
+    args = parser.parse_args()
+
+    benchmarks = {
+        'env_step': lambda: bench_env_step(args.steps),
+        'move_checker': lambda: bench_move_checker(args.steps),
+        'convert_board': lambda: bench_convert_board(args.steps),
+        'sae_step': lambda: bench_sae_step(args.sae_steps, args.latency),
+        'sac_learn': lambda: bench_sac_learn(args.sac_steps, args.num_envs, args.latency),
+        'startup': lambda: bench_startup(max(args.num_envs)),
+    }
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': time.time(),
+        'args': vars(args),
+        'results': {},
+    }
+
+    for name, benchmark in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+
+        print(f"Running {name}")
+        # The environments print on construction
+        with contextlib.redirect_stdout(io.StringIO()):
+            report['results'][name] = benchmark()
+        print(json.dumps(report['results'][name], indent=2))
+
+    output = args.output or os.path.join(OUTPUT_DIR, f"{(commit or 'unknown')[:12]}.json")
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved results to {output}")
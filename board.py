@@ -0,0 +1,169 @@
+"""
+Bitboard representation of a tic-tac-toe position.
+
+A position is two 9 bit masks, one per player, where bit i is set if the player owns cell i.
+Wins are checked against 8 precomputed masks and legal moves come from the complement of
+the occupied cells. The base 3 position key doubles as an index into the solved table.
+"""
+import numpy as np
+
+FULL_MASK = (1 << 9) - 1
+
+WIN_MASKS = (
+    0b000000111, 0b000111000, 0b111000000,  # rows
+    0b001001001, 0b010010010, 0b100100100,  # columns
+    0b100010001, 0b001010100                # diagonals
+)
+
+# Lookup from a move mask to the moves it contains
+MASK_TO_MOVES = tuple(tuple(i for i in range(9) if mask >> i & 1) for mask in range(1 << 9))
+
+# Base 3 contribution of each mask, X cells count 1 and O cells count 2
+MASK_TO_BASE3 = tuple(sum(3 ** i for i in moves) for moves in MASK_TO_MOVES)
+
+# Observation rows used by Stable Baselines, 0 for empty, 1 for X and 2 for O
+MASK_TO_CELLS = np.array([[mask >> i & 1 for i in range(9)] for mask in range(1 << 9)], dtype=int)
+
+def is_winning_mask(mask):
+    for win_mask in WIN_MASKS:
+        if mask & win_mask == win_mask:
+            return True
+    return False
+
+# Precomputed so a win check is a single tuple lookup
+WINNING_MASKS = tuple(is_winning_mask(mask) for mask in range(1 << 9))
+
+class Board:
+
+    __slots__ = ('x', 'o')
+
+    def __init__(self, x=0, o=0):
+        self.x = x
+        self.o = o
+
+    @classmethod
+    def from_list(cls, board):
+        """
+        Builds a board from the list form, which holds 'X', 'O' or the cell number
+        """
+        x = o = 0
+        for i, cell in enumerate(board):
+            if cell == 'X':
+                x |= 1 << i
+            elif cell == 'O':
+                o |= 1 << i
+        return cls(x, o)
+
+    @classmethod
+    def from_key(cls, key):
+        x = o = 0
+        for i in range(9):
+            key, cell = divmod(key, 3)
+            if cell == 1:
+                x |= 1 << i
+            elif cell == 2:
+                o |= 1 << i
+        return cls(x, o)
+
+    @property
+    def occupied(self):
+        return self.x | self.o
+
+    @property
+    def key(self):
+        return MASK_TO_BASE3[self.x] + 2 * MASK_TO_BASE3[self.o]
+
+    def copy(self):
+        return Board(self.x, self.o)
+
+    def is_empty(self, move):
+        return not self.occupied >> move & 1
+
+    def place(self, move, player):
+        if player == 'X':
+            self.x |= 1 << move
+        else:
+            self.o |= 1 << move
+
+    def remove(self, move):
+        self.x &= ~(1 << move)
+        self.o &= ~(1 << move)
+
+    def legal_moves(self):
+        return MASK_TO_MOVES[FULL_MASK & ~self.occupied]
+
+    def winner(self):
+        """
+        Returns 'X' or 'O' if that player has three in a row, None otherwise
+        """
+        if WINNING_MASKS[self.x]:
+            return 'X'
+        if WINNING_MASKS[self.o]:
+            return 'O'
+        return None
+
+    def is_full(self):
+        return self.occupied == FULL_MASK
+
+    def to_list(self):
+        return [self[i] for i in range(9)]
+
+    def to_observation(self):
+        return MASK_TO_CELLS[self.x] + 2 * MASK_TO_CELLS[self.o]
+
+    def __getitem__(self, move):
+        if self.x >> move & 1:
+            return 'X'
+        if self.o >> move & 1:
+            return 'O'
+        return move + 1
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __len__(self):
+        return 9
+
+    def __eq__(self, other):
+        return isinstance(other, Board) and self.x == other.x and self.o == other.o
+
+    def __hash__(self):
+        return hash((self.x, self.o))
+
+    def __repr__(self):
+        return f"Board({self.to_list()})"
+
+def as_board(board):
+    """
+    Accepts either a Board or the list form and returns a Board
+    """
+    return board if isinstance(board, Board) else Board.from_list(board)
+
+def board_key(board):
+    return as_board(board).key
+
+# Tables indexed by position key, used by the batched environments
+POW3 = 3 ** np.arange(9)
+NUM_KEYS = 3 ** 9
+
+# Cell codes for every key, 0 for empty, 1 for X and 2 for O
+KEY_CELLS = (np.arange(NUM_KEYS)[:, None] // POW3) % 3
+
+def _key_outcomes():
+    """
+    0 if the game is still going, 1 if X has won, 2 if O has won and 3 for a draw
+    """
+    outcomes = np.zeros(NUM_KEYS, dtype=np.int8)
+    for code in (1, 2):
+        owned = KEY_CELLS == code
+        for win_mask in WIN_MASKS:
+            cells = list(MASK_TO_MOVES[win_mask])
+            outcomes[owned[:, cells].all(axis=1) & (outcomes == 0)] = code
+    outcomes[(KEY_CELLS != 0).all(axis=1) & (outcomes == 0)] = 3
+    return outcomes
+
+KEY_OUTCOMES = _key_outcomes()
+
+# Number of moves in each mask and the moves themselves, padded with -1
+MASK_POPCOUNT = np.array([len(moves) for moves in MASK_TO_MOVES], dtype=np.int64)
+MASK_MOVES_PADDED = np.array([list(moves) + [-1] * (9 - len(moves)) for moves in MASK_TO_MOVES], dtype=np.int64)
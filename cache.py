@@ -0,0 +1,153 @@
+"""
+On-disk cache of LLM moves keyed on the prompt, the board and the quantized steering vector.
+
+The cache lives in a SQLite file so that every environment worker can share it. Entries
+are evicted least recently used first once the cache grows past max_entries.
+
+With symmetric=True, boards are keyed on their canonical board (see symmetry.py) and moves
+are stored in its orientation, so one completion answers all 8 equivalent boards. This
+assumes the model answers a rotated board with the rotated move, which the steering does
+not guarantee, so it is off by default.
+"""
+import os, json, time, hashlib, sqlite3, threading
+import numpy as np
+
+from utils import add_statistic
+from prompting import prompt_builder
+from symmetry import CANONICAL_KEY, CANONICAL_SYMMETRY, PERMUTATIONS, MOVE_MAPS, to_canonical_move, from_canonical_move
+
+CACHE_PATH = 'output/completion_cache.sqlite'
+
+class CompletionCache:
+    """
+    Args:
+        path: SQLite file shared by all processes using the cache
+        grid: Steering values are rounded to multiples of grid before being applied and cached
+        max_entries: Least recently used entries are evicted above this size
+        symmetric: Share entries between symmetric boards
+    """
+
+    def __init__(self, path=CACHE_PATH, grid=0.02, max_entries=100_000, symmetric=False):
+        self.path = path
+        self.grid = grid
+        self.max_entries = max_entries
+        self.symmetric = symmetric
+        self.stats = {}
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        # Connections cannot be shared across processes or threads, so each one opens its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS completions ('
+                'key TEXT PRIMARY KEY, completion TEXT, move INTEGER, last_used REAL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS last_used_index ON completions (last_used)')
+            self._local.connection = connection
+        return connection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def quantize(self, action):
+        return tuple(int(x) for x in np.rint(np.asarray(action, dtype=float) / self.grid))
+
+    def dequantize(self, quantized):
+        return np.asarray(quantized, dtype=float) * self.grid
+
+    def symmetry(self, board_key):
+        """
+        Symmetry between the board and the board its entries are stored for, 0 is the identity
+        """
+        return int(CANONICAL_SYMMETRY[board_key]) if self.symmetric else 0
+
+    def make_key(self, model, api_format, board_key, quantized, move_selection='completion'):
+        if self.symmetric:
+            # The user message holds the board, so the unrendered template stands in for it
+            prompt = api_format['system']['content'] + prompt_builder().user_template
+            board_key = int(CANONICAL_KEY[board_key])
+        else:
+            prompt = api_format['system']['content'] + api_format['user']['content']
+        prompt_hash = hashlib.sha1(prompt.encode()).hexdigest()
+        
+        # Distribution entries hold probabilities instead of a completion, see put_distribution
+        if move_selection != 'completion':
+            quantized = (quantized, 'distribution')
+        return hashlib.sha1(repr((model, prompt_hash, board_key, quantized)).encode()).hexdigest()
+
+    def get(self, key, symmetry=0):
+        """
+        Returns (completion, move) if the key is cached, None otherwise.
+        The move is mapped back from the stored board by symmetry.
+        """
+        row = self.connection.execute('SELECT completion, move FROM completions WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            add_statistic(self.stats, 'miss')
+            return None
+
+        add_statistic(self.stats, 'hit')
+        self.connection.execute('UPDATE completions SET last_used = ? WHERE key = ?', (time.time(), key))
+        return row[0], from_canonical_move(row[1], symmetry)
+
+    def put(self, key, completion, move, symmetry=0):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO completions (key, completion, move, last_used) VALUES (?, ?, ?, ?)',
+            (key, completion, to_canonical_move(move, symmetry), time.time())
+        )
+        add_statistic(self.stats, 'insert')
+
+        # Checking the size on every insert would be wasteful
+        if self.stats['insert'] % 100 == 0:
+            self.evict()
+
+    def get_distribution(self, key, symmetry=0):
+        """
+        Returns the cached move probabilities of the key, None if it is not cached
+        """
+        hit = self.get(key)
+        if hit is None:
+            return None
+        return np.array(json.loads(hit[0]))[MOVE_MAPS[symmetry]]
+
+    def put_distribution(self, key, probabilities, symmetry=0):
+        """
+        Caches the move probabilities instead of a chosen move, so that moves sampled from
+        them stay random and punishments for an occupied top cell are applied on every hit
+        """
+        canonical = np.asarray(probabilities, dtype=float)[PERMUTATIONS[symmetry]]
+        self.put(key, json.dumps(canonical.tolist()), int(np.argmax(canonical)))
+
+    def evict(self):
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                'DELETE FROM completions WHERE key IN (SELECT key FROM completions ORDER BY last_used LIMIT ?)',
+                (excess,)
+            )
+
+    def hit_rate(self):
+        lookups = self.stats.get('hit', 0) + self.stats.get('miss', 0)
+        return self.stats.get('hit', 0) / lookups if lookups else 0.0
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+
+    def close(self):
+        # Only the calling thread's connection, the others are closed when their threads end
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
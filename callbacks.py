@@ -0,0 +1,244 @@
+import os, copy, json, time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch as th
+from stable_baselines3 import SAC
+from stable_baselines3.common.callbacks import BaseCallback
+from stable_baselines3.common.monitor import Monitor
+
+from tracing import tracer, Tracer
+from metrics import metrics
+
+class TracingCallback(BaseCallback):
+    """
+    Exports the timings and counters collected by tracing.tracer to the SB3 logger.
+    Environments created with trace=True send their data through the step infos, so this
+    works with SubprocVecEnv workers as well. Time spent between rollouts is logged as train.
+
+    Args:
+        log_freq: Number of calls to the callback between exports
+    """
+
+    def __init__(self, log_freq=100, verbose=0):
+        super().__init__(verbose)
+        self.log_freq = log_freq
+        self.window = Tracer(enabled=True)
+        self.totals = {}
+        self.rollout_end = None
+
+    def _on_training_start(self):
+        tracer.enabled = True
+
+    def _on_rollout_start(self):
+        # Gradient steps happen between the end of one rollout and the start of the next
+        if self.rollout_end is not None:
+            self.window.timings['train'].append(time.perf_counter() - self.rollout_end)
+
+    def _on_rollout_end(self):
+        self.rollout_end = time.perf_counter()
+
+    def _on_step(self):
+        for info in self.locals.get('infos', []):
+            if 'trace' in info:
+                self.window.merge(info.pop('trace'))
+        self.window.merge(tracer.drain())
+
+        if self.n_calls % self.log_freq == 0:
+            self.export()
+        return True
+
+    def export(self):
+        snapshot = self.window.drain()
+
+        for name, durations in snapshot['timings'].items():
+            durations = np.asarray(durations) * 1000
+            self.logger.record(f"trace/{name}_mean_ms", float(durations.mean()))
+            self.logger.record(f"trace/{name}_p99_ms", float(np.percentile(durations, 99)))
+            self.logger.record(f"trace/{name}_calls", len(durations))
+            self.logger.record(f"trace/{name}_ms", th.as_tensor(durations), exclude=('stdout', 'log', 'json', 'csv'))
+            metrics.emit('timing', name=name, mean_ms=float(durations.mean()), p99_ms=float(np.percentile(durations, 99)), calls=len(durations))
+
+        for name, amount in snapshot['counters'].items():
+            self.totals[name] = self.totals.get(name, 0) + amount
+            self.logger.record(f"trace/{name}", self.totals[name])
+
+class MetricsMonitor(Monitor):
+    """
+    Monitor that reports finished episodes to the metrics sink instead of a CSV file.
+    SB3 still receives the episode info, e.g. for the rollout statistics. In SubprocVecEnv
+    workers the step's events, including its episode, are sent in info['metrics'].
+
+    Args:
+        env: Environment to wrap
+        env_id: Number of the environment, stored with its events
+    """
+
+    def __init__(self, env, env_id=0):
+        super().__init__(env, filename=None)
+        self.env_id = env_id
+
+    def step(self, action):
+        observation, reward, terminated, truncated, info = super().step(action)
+        if 'episode' in info:
+            episode = info['episode']
+            metrics.emit('episode', env=self.env_id, reward=float(episode['r']), length=int(episode['l']), seconds=float(episode['t']))
+        
+        # Drained after the episode so that it is sent with the step that finished it
+        if metrics.forwarding:
+            info['metrics'] = metrics.drain()
+        return observation, reward, terminated, truncated, info
+
+class MetricsCallback(BaseCallback):
+    """
+    Moves the events forwarded by SubprocVecEnv workers into the metrics sink
+    """
+
+    def _on_step(self):
+        for info in self.locals.get('infos', []):
+            for event in info.pop('metrics', ()):
+                metrics.put(event)
+        return True
+
+# Replay buffer arrays written to every segment
+BUFFER_ARRAYS = ('observations', 'next_observations', 'actions', 'rewards', 'dones', 'timeouts')
+
+def read_manifest(directory):
+    path = os.path.join(directory, 'checkpoint.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+class AsyncCheckpointCallback(BaseCallback):
+    """
+    Checkpoints an off-policy model without pausing training to pickle the replay buffer.
+    The full model is saved once when training starts. Every save_freq calls the weights and
+    optimizer states are copied, together with the replay buffer rows added since the last
+    checkpoint, and written on a background thread. The buffer is stored as append-only
+    segments and checkpoint.json is written last, so it always describes a complete checkpoint.
+    Restore with load_checkpoint.
+
+    Args:
+        save_freq: Number of calls to the callback between checkpoints
+        save_path: Directory of the checkpoint, an existing checkpoint is continued
+    """
+
+    def __init__(self, save_freq, save_path, verbose=0):
+        super().__init__(verbose)
+        self.save_freq = save_freq
+        self.save_path = save_path
+        self.executor = None
+
+    def _on_training_start(self):
+        os.makedirs(self.save_path, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        buffer = self.model.replay_buffer
+
+        manifest = read_manifest(self.save_path)
+        self.segments = 0 if manifest is None else manifest['segments']
+        self.parameters_file = None if manifest is None else manifest['parameters']
+        self.saved_timesteps = self.num_timesteps
+
+        # Rows already in the buffer, e.g. from load_replay_buffer, go into the first segment
+        self.saved_pos = 0 if manifest is None else buffer.pos
+        self.save_all = manifest is None and buffer.full
+
+        self.model.save(os.path.join(self.save_path, 'model'))
+
+    def _on_step(self):
+        if self.n_calls % self.save_freq == 0:
+            self.checkpoint()
+        return True
+
+    def _on_training_end(self):
+        self.checkpoint()
+        self.executor.shutdown(wait=True)
+
+    def checkpoint(self):
+        """
+        Copies the state to save on the training thread and queues the writes
+        """
+        buffer = self.model.replay_buffer
+
+        # The step that triggered the callback is stored after it, so rows are counted from the
+        # buffer position and the step count only tells whether the buffer wrapped all the way
+        added = (self.num_timesteps - self.saved_timesteps) // buffer.n_envs * getattr(buffer, 'copies_per_step', 1)
+        if self.save_all or added >= buffer.buffer_size:
+            count = buffer.buffer_size
+        else:
+            count = (buffer.pos - self.saved_pos) % buffer.buffer_size
+        start = (buffer.pos - count) % buffer.buffer_size
+        rows = (start + np.arange(count)) % buffer.buffer_size
+
+        segment = {name: getattr(buffer, name)[rows] for name in BUFFER_ARRAYS if getattr(buffer, name, None) is not None}
+        segment['start'] = np.array(start)
+
+        parameters = copy.deepcopy(self.model.get_parameters())
+        if getattr(self.model, 'log_ent_coef', None) is not None:
+            parameters['log_ent_coef'] = self.model.log_ent_coef.detach().clone()
+
+        manifest = {
+            'model': 'model.zip',
+            'parameters': f'parameters_{self.num_timesteps}.pt',
+            'segments': self.segments + (count > 0),
+            'pos': int(buffer.pos),
+            'full': bool(buffer.full),
+            'num_timesteps': self.num_timesteps,
+        }
+        previous_parameters = self.parameters_file
+        segment_index = self.segments if count > 0 else None
+
+        self.executor.submit(self._write, segment_index, segment, parameters, manifest, previous_parameters)
+
+        self.segments = manifest['segments']
+        self.parameters_file = manifest['parameters']
+        self.saved_timesteps = self.num_timesteps
+        self.saved_pos = buffer.pos
+        self.save_all = False
+
+    def _write(self, segment_index, segment, parameters, manifest, previous_parameters):
+        if segment_index is not None:
+            np.savez(os.path.join(self.save_path, f'segment_{segment_index:05d}.npz'), **segment)
+        th.save(parameters, os.path.join(self.save_path, manifest['parameters']))
+
+        temporary_path = os.path.join(self.save_path, 'checkpoint.json.tmp')
+        with open(temporary_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temporary_path, os.path.join(self.save_path, 'checkpoint.json'))
+
+        # Only the newest weights are kept, the buffer needs every segment
+        if previous_parameters is not None and previous_parameters != manifest['parameters']:
+            previous_path = os.path.join(self.save_path, previous_parameters)
+            if os.path.exists(previous_path):
+                os.remove(previous_path)
+
+def load_checkpoint(directory, env, model_class=SAC, **kwargs):
+    """
+    Restores a model saved by AsyncCheckpointCallback, with its weights and replay buffer
+    """
+    manifest = read_manifest(directory)
+    if manifest is None:
+        raise FileNotFoundError(f"No checkpoint.json in {directory}")
+
+    model = model_class.load(os.path.join(directory, manifest['model']), env=env, **kwargs)
+
+    parameters = th.load(os.path.join(directory, manifest['parameters']), weights_only=False)
+    log_ent_coef = parameters.pop('log_ent_coef', None)
+    model.set_parameters(parameters)
+    if log_ent_coef is not None:
+        with th.no_grad():
+            model.log_ent_coef.copy_(log_ent_coef)
+
+    # Segments are replayed in order, later rows overwrite older ones like in the buffer itself
+    buffer = model.replay_buffer
+    for index in range(manifest['segments']):
+        with np.load(os.path.join(directory, f'segment_{index:05d}.npz')) as segment:
+            rows = (int(segment['start']) + np.arange(len(segment['rewards']))) % buffer.buffer_size
+            for name in BUFFER_ARRAYS:
+                if name in segment:
+                    getattr(buffer, name)[rows] = segment[name]
+    buffer.pos = manifest['pos']
+    buffer.full = manifest['full']
+
+    model.num_timesteps = manifest['num_timesteps']
+    return model
@@ -0,0 +1,180 @@
+"""
+Asynchronous completion layer used to query the API for many environments at once.
+
+Requests from every environment are issued concurrently from one event loop. A shared
+token bucket keeps the request rate under the API limit and rate limit errors are retried
+with jittered exponential backoff instead of sleeping for a fixed time.
+"""
+import time, random, asyncio, threading
+
+from constants import RATE_LIMIT_PER_MINUTE, RETRY_COUNT
+from tracing import tracer
+from metrics import metrics
+from backends import is_rate_limit_error
+from utils import add_statistic, check_move, fallback_move, choose_move, move_probabilities, OccupiedCellError, default_backend
+
+class TokenBucket:
+    """
+    Allows rate_per_minute requests per minute with bursts of up to capacity requests
+    """
+
+    def __init__(self, rate_per_minute=RATE_LIMIT_PER_MINUTE, capacity=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else max(1, rate_per_minute // 10)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class BlockingTokenBucket(TokenBucket):
+    """
+    TokenBucket for requests made from several threads. It can be used as the semaphore of a
+    backends.BudgetedBackend, acquiring waits for a token and releasing does nothing.
+    """
+
+    def __init__(self, rate_per_minute=RATE_LIMIT_PER_MINUTE, capacity=None):
+        super().__init__(rate_per_minute, capacity)
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class AsyncCompleter:
+    """
+    Issues chat completions concurrently under a shared rate limit
+
+    Args:
+        backend: Backend serving the completions, defaults to the Goodfire API
+        rate_limiter: TokenBucket shared by every request, pass None to disable rate limiting
+        max_attempts: Number of attempts before a rate limited request is given up on
+        base_delay: Initial backoff in seconds, doubled after each rate limit error
+        max_delay: Upper bound on the backoff
+    """
+
+    def __init__(self, backend=None, rate_limiter=TokenBucket, max_attempts=3, base_delay=2, max_delay=60, seed=None):
+        self.backend = backend if backend is not None else default_backend
+        self.rate_limiter = rate_limiter() if rate_limiter is TokenBucket else rate_limiter
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.random = random.Random(seed)
+        self.stats = {}
+
+        self.loop = asyncio.new_event_loop()
+
+    def backoff(self, attempt):
+        # Full jitter so that environments hitting the limit together do not retry together
+        return self.random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def call(self, function, *args, span='get_completion', **kwargs):
+        """
+        Awaits a backend call under the rate limit, retrying rate limit errors with backoff
+        """
+        for attempt in range(self.max_attempts):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+
+            try:
+                add_statistic(self.stats, 'requests')
+                with tracer.span(span):
+                    return await function(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    raise
+                add_statistic(self.stats, 'rate_limited')
+                tracer.count('rate_limit_hits')
+                if attempt == self.max_attempts - 1:
+                    raise
+                await asyncio.sleep(self.backoff(attempt))
+
+    async def complete(self, model, api_format):
+        return await self.call(
+            self.backend.complete_async,
+            model,
+            [
+            api_format['system'],
+            api_format['user']
+        ],
+            max_completion_tokens=25
+        )
+
+    async def move_logits(self, model, api_format):
+        return await self.call(
+            self.backend.move_logits_async,
+            model,
+            [api_format['system'], api_format['user']],
+            span='get_move_logits'
+        )
+
+    async def get_valid_move(self, agent, state, api_format, is_sae_rl=False):
+        """
+        Async version of utils.get_valid_move, invalid answers are retried without sleeping
+        """
+        if getattr(agent, 'move_selection', 'completion') != 'completion':
+            try:
+                logits = await self.move_logits(agent.model, api_format)
+            except Exception as e:
+                add_statistic(agent.stats, 'invalid_move')
+                metrics.emit('invalid_answer', error=repr(e), occupied=False)
+                return fallback_move(agent, state, False, is_sae_rl)
+            return choose_move(agent, state, move_probabilities(logits), is_sae_rl)
+
+        for _ in range(RETRY_COUNT):
+
+            minor_punish = False
+
+            try:
+                completion_text = await self.complete(agent.model, api_format)
+                return check_move(state, completion_text), completion_text
+            except Exception as e:
+                minor_punish = isinstance(e, OccupiedCellError)
+                add_statistic(agent.stats, 'invalid_move')
+                tracer.count('retries')
+                metrics.emit('invalid_answer', error=repr(e), occupied=minor_punish)
+
+        return fallback_move(agent, state, minor_punish, is_sae_rl)
+
+    def get_valid_moves(self, agents, states, api_formats, is_sae_rl=False):
+        """
+        Gets a valid move for every agent concurrently, returns a list of (move, completion_text)
+        """
+        requests = [
+            self.get_valid_move(agent, state, api_format, is_sae_rl=is_sae_rl)
+            for agent, state, api_format in zip(agents, states, api_formats)
+        ]
+
+        async def gather():
+            return await asyncio.gather(*requests)
+
+        return self.loop.run_until_complete(gather())
+
+    def close(self):
+        self.loop.close()
@@ -4,6 +4,7 @@ STUDENT = 'O'
 NUM_GAMES = 1
 NUM_ACTIONS_SAE = 20 # This is not really a constant and depends on detected features
 NUM_WORKERS = 4 # API seems to be rate limited to 100 requests per minute
+RATE_LIMIT_PER_MINUTE = 100 # Shared by every environment using the async completion layer
 NUM_ENVS = 6
 
 RETRY_COUNT = 2
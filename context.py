@@ -0,0 +1,149 @@
+"""
+Batch collection of the top SAE features behind the moves of an LLMAgent.
+
+Games are played first and the moves queued on the agent. collect_context then deduplicates
+the (board, response) pairs, inspects them concurrently under the rate limit and appends the
+top features of each pair to a JSON lines file as soon as it is inspected. Pairs already in
+the file are skipped, so an interrupted collection can be resumed.
+"""
+import os, json, uuid, asyncio
+from types import SimpleNamespace
+
+from board import board_key, Board
+from completions import AsyncCompleter
+from utils import append_statistic, find_move_token
+
+CONTEXT_PATH = 'output/context/top_features.jsonl'
+
+def context_messages(api_format):
+    return [
+        api_format['system'],
+        api_format['user'],
+        api_format['assistant']
+    ]
+
+def serialize_activations(activations):
+    return [
+        {
+            'uuid': str(activation.feature.uuid),
+            'label': activation.feature.label,
+            'index_in_sae': activation.feature.index_in_sae,
+            'activation': activation.activation,
+        }
+        for activation in activations
+    ]
+
+def deserialize_activations(records):
+    import goodfire
+    return [
+        SimpleNamespace(
+            feature=goodfire.Feature(uuid.UUID(record['uuid']), record['label'], record['index_in_sae']),
+            activation=record['activation']
+        )
+        for record in records
+    ]
+
+def read_context(path=CONTEXT_PATH):
+    """
+    Yields every record written by collect_context
+    """
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def load_top_features(path=CONTEXT_PATH):
+    """
+    Returns the records in the same layout as LLMAgent.stats['top_features']
+    """
+    top_features = {}
+    for record in read_context(path):
+        board = tuple(Board.from_key(record['board_key']))
+        append_statistic(top_features, board, deserialize_activations(record['features']))
+    return top_features
+
+def pair_key(board, response):
+    return f"{board_key(board)}:{response}"
+
+class ContextCollector:
+    """
+    Args:
+        backend: Backend used for feature inspection
+        path: JSON lines file the top features are appended to
+        completer: AsyncCompleter providing the rate limit and backoff
+        k: Number of top features kept per move
+    """
+
+    def __init__(self, backend, path=CONTEXT_PATH, completer=None, k=5):
+        self.backend = backend
+        self.path = path
+        self.completer = completer if completer is not None else AsyncCompleter(backend)
+        self.k = k
+
+    def completed(self):
+        return {record['pair'] for record in read_context(self.path)}
+
+    async def _inspect(self, model, item):
+        # Answers without a valid move are recorded without features so they are not asked again
+        if item['move'] is None:
+            return item, []
+
+        context = await self.completer.call(self.backend.inspect_async, context_messages(item['api_format']), model, span='inspect')
+        token = find_move_token(context, item['move'])
+        activations = token.inspect(self.k) if token is not None else []
+        return item, activations
+
+    async def _collect(self, model, items, output):
+        written = 0
+        tasks = [self._inspect(model, item) for item in items]
+        for task in asyncio.as_completed(tasks):
+            try:
+                item, activations = await task
+            except Exception as e:
+                print("Error inspecting features", e)
+                continue
+
+            record = {
+                'pair': item['pair'],
+                'board_key': board_key(item['state']),
+                'move': item['move'],
+                'response': item['api_format']['assistant']['content'],
+                'features': serialize_activations(activations),
+            }
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+            written += 1
+        return written
+
+    def collect(self, model, items):
+        """
+        Inspects every item that is not in the file yet and returns how many records were written,
+        failed inspections are left out and retried by the next call.
+        Each item is a dict with the state, the move and the api_format including the response.
+        Items are deduplicated on their (board, response) pair unless they carry their own 'pair' key.
+        """
+        done = self.completed()
+        pending = {}
+        for item in items:
+            key = item.get('pair') or pair_key(item['state'], item['api_format']['assistant']['content'])
+            if key not in done and key not in pending:
+                pending[key] = {**item, 'pair': key}
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with open(self.path, 'a') as output:
+            return self.completer.loop.run_until_complete(self._collect(model, list(pending.values()), output))
+
+def collect_context(agent, path=CONTEXT_PATH, completer=None):
+    """
+    Inspects the moves queued by an LLMAgent with get_context=True and fills agent.stats['top_features']
+    """
+    collector = ContextCollector(agent.backend, path, completer)
+    collector.collect(agent.model, agent.pending_context)
+    agent.pending_context = []
+    agent.stats['top_features'] = load_top_features(path)
+    return agent.stats['top_features']
@@ -0,0 +1,239 @@
+"""
+Exact evaluation of a student policy against OptimalAgent.
+
+Instead of sampling games, every board the student can face is enumerated once, the policy
+is asked for its move probabilities on all of them in one batch and the game tree is walked
+with the teacher picking uniformly among its optimal moves, like OptimalAgent does. This
+gives the exact win, draw and loss probabilities of the policy and, for every board, the
+probability of reaching it and of playing an optimal move there.
+
+A policy is a function from an (N, 9) array of observations to an (N, 9) array of move
+probabilities. Probability on occupied cells is dropped and the rest renormalized, rows
+without any probability on a free cell are treated as a uniformly random move.
+"""
+import numpy as np
+
+from board import Board, KEY_CELLS, KEY_OUTCOMES, POW3
+from constants import TEACHER, STUDENT
+from vec_env import X_WINS, O_WINS, DRAW
+
+# Columns of the outcome arrays, from the student's point of view
+WIN, DRAW_OUTCOME, LOSS = 0, 1, 2
+
+def teacher_replies(board, move_checker, teacher=TEACHER):
+    """
+    Returns the boards after each of the teacher's optimal moves
+    """
+    replies = []
+    for move in move_checker.get_optimal_moves(board, teacher):
+        reply = board.copy()
+        reply.place(move, teacher)
+        replies.append(reply)
+    return replies
+
+def student_boards(move_checker, teacher=TEACHER, student=STUDENT):
+    """
+    Returns every non terminal board the student can face, with fewer pieces first, and the
+    boards the games start from
+    """
+    openings = teacher_replies(Board(), move_checker, teacher)
+    boards = {}
+    frontier = [board for board in openings if KEY_OUTCOMES[board.key] == 0]
+    while frontier:
+        next_frontier = []
+        for board in frontier:
+            if board.key in boards:
+                continue
+            boards[board.key] = board
+            for move in board.legal_moves():
+                after = board.copy()
+                after.place(move, student)
+                if KEY_OUTCOMES[after.key] != 0:
+                    continue
+                next_frontier += [reply for reply in teacher_replies(after, move_checker, teacher) if KEY_OUTCOMES[reply.key] == 0]
+        frontier = next_frontier
+
+    return sorted(boards.values(), key=lambda board: bin(board.occupied).count('1')), openings
+
+def normalize(probabilities, observations):
+    """
+    Restricts move probabilities to the free cells, returns them and the dropped probability per row
+    """
+    probabilities = np.clip(np.asarray(probabilities, dtype=np.float64), 0, None)
+    free = observations == 0
+    legal = np.where(free, probabilities, 0.0)
+    total = legal.sum(axis=1, keepdims=True)
+
+    # A policy that only puts weight on occupied cells ends in the random fallback move
+    uniform = free / free.sum(axis=1, keepdims=True)
+    normalized = np.where(total > 0, legal / np.where(total > 0, total, 1), uniform)
+
+    row_totals = probabilities.sum(axis=1)
+    illegal = np.where(row_totals > 0, 1 - total[:, 0] / np.where(row_totals > 0, row_totals, 1), 0.0)
+    return normalized, illegal
+
+def outcome_of(key):
+    """
+    Returns the student's outcome vector for a finished game, None if the game is not over
+    """
+    outcome = KEY_OUTCOMES[key]
+    if outcome == 0:
+        return None
+    vector = np.zeros(3)
+    vector[{O_WINS: WIN, DRAW: DRAW_OUTCOME, X_WINS: LOSS}[outcome]] = 1
+    return vector
+
+def evaluate_exact(policy, move_checker, teacher=TEACHER, student=STUDENT):
+    """
+    Computes the exact results of the policy against OptimalAgent, see the module docstring.
+    The policy is called once, with every board the student can face.
+
+    Returns a dict with the win, draw and loss probabilities, the expected share of the
+    student's moves that are optimal and per board arrays: keys, reach probability,
+    probability of an optimal move, probability on occupied cells and outcome probabilities.
+    """
+    boards, openings = student_boards(move_checker, teacher, student)
+    keys = np.array([board.key for board in boards], dtype=np.int64)
+    index = {key: i for i, key in enumerate(keys)}
+    observations = KEY_CELLS[keys]
+
+    probabilities, illegal = normalize(policy(observations), observations)
+
+    optimal = np.zeros(len(boards))
+    for i, board in enumerate(boards):
+        optimal[i] = probabilities[i, list(move_checker.get_optimal_moves(board, student))].sum()
+
+    # Boards with more pieces come later, so walking backwards every successor is already known
+    outcomes = np.zeros((len(boards), 3))
+    successors = [[] for _ in boards]
+    for i in reversed(range(len(boards))):
+        for move in boards[i].legal_moves():
+            after = boards[i].copy()
+            after.place(move, student)
+            finished = outcome_of(after.key)
+            if finished is not None:
+                outcomes[i] += probabilities[i, move] * finished
+                continue
+
+            # The teacher's optimal moves are equally likely
+            replies = teacher_replies(after, move_checker, teacher)
+            for reply in replies:
+                finished = outcome_of(reply.key)
+                if finished is None:
+                    successors[i].append((index[reply.key], probabilities[i, move] / len(replies)))
+                    finished = outcomes[index[reply.key]]
+                outcomes[i] += probabilities[i, move] / len(replies) * finished
+
+    # Reach probabilities are pushed forwards from the openings in the same order
+    reach = np.zeros(len(boards))
+    for opening in openings:
+        if opening.key in index:
+            reach[index[opening.key]] += 1 / len(openings)
+    for i in range(len(boards)):
+        for j, probability in successors[i]:
+            reach[j] += reach[i] * probability
+
+    start = np.zeros(3)
+    for opening in openings:
+        finished = outcome_of(opening.key)
+        start += finished if finished is not None else outcomes[index[opening.key]]
+    start /= len(openings)
+
+    return {
+        'wins': float(start[WIN]),
+        'draws': float(start[DRAW_OUTCOME]),
+        'losses': float(start[LOSS]),
+        'optimal_move_rate': float((reach * optimal).sum() / reach.sum()),
+        'illegal_probability': float((reach * illegal).sum() / reach.sum()),
+        'num_states': len(boards),
+        'keys': keys,
+        'reach': reach,
+        'optimal': optimal,
+        'illegal': illegal,
+        'outcomes': outcomes,
+    }
+
+def random_policy(observations):
+    """
+    Uniform over the free cells, the moves of RandomAgent
+    """
+    return (observations == 0).astype(np.float64)
+
+def agent_policy(agent):
+    """
+    Policy of an agent whose act returns a move, asked once per board
+    """
+    def policy(observations):
+        probabilities = np.zeros(observations.shape)
+        for i, observation in enumerate(observations):
+            probabilities[i, agent.act(Board.from_key(int(observation @ POW3)))] = 1
+        return probabilities
+    return policy
+
+def move_distribution_policy(move_counts):
+    """
+    Policy given by counts of the moves played on each board, e.g. the LLM's answers in a
+    step log, see step_log_move_counts. Boards without counts get a uniformly random move.
+    """
+    def policy(observations):
+        keys = observations @ POW3
+        return np.array([move_counts.get(int(key), np.zeros(9)) for key in keys], dtype=np.float64)
+    return policy
+
+def step_log_move_counts(directory):
+    """
+    Counts the moves played on every board of a step log, leaving out random fallback moves
+    """
+    from recorder import StepLog, FLAG_FALLBACK
+
+    log = StepLog(directory)
+    keys = np.asarray(log['board_key'], dtype=np.int64)
+    moves = np.asarray(log['move'], dtype=np.int64)
+    answered = (np.asarray(log['flags']) & FLAG_FALLBACK) == 0
+
+    move_counts = {}
+    for key, move in zip(keys[answered], moves[answered]):
+        move_counts.setdefault(int(key), np.zeros(9))[move] += 1
+    return move_counts
+
+def actor_policy(model, env, samples=8):
+    """
+    Policy of a trained SAC student in a TicTacToeSAE environment. The actor gives the steering
+    for every board in one forward pass, then the environment's model is asked for the moves.
+
+    With move_selection 'sample' or 'argmax' the move distribution is requested once per board,
+    so the results are exact. With completions the distribution is estimated from samples
+    answers per board, answers without a move are left out and boards without any get the
+    random fallback move. The results are then only exact for that estimate.
+    The environment's board is restored afterwards.
+    """
+    from utils import get_completion, get_move_logits, move_probabilities, extract_move
+
+    def policy(observations):
+        actions, _ = model.predict(observations, deterministic=True)
+        probabilities = np.zeros(observations.shape)
+        board = env.board
+        try:
+            for i, (observation, action) in enumerate(zip(observations, actions)):
+                env.board = Board.from_key(int(observation @ POW3))
+                api_format = env.prepare_completion(action)
+
+                if env.move_selection == 'completion':
+                    for _ in range(samples):
+                        try:
+                            probabilities[i, extract_move(get_completion(env.model, api_format, env.backend))] += 1
+                        except ValueError:
+                            pass
+                    continue
+
+                distribution = move_probabilities(get_move_logits(env.model, api_format, env.backend))
+                if env.move_selection == 'argmax':
+                    legal = np.where(observation == 0, distribution, 0.0)
+                    distribution = np.zeros(9)
+                    if legal.sum() > 0:
+                        distribution[np.argmax(legal)] = 1
+                probabilities[i] = distribution
+        finally:
+            env.board = board
+        return probabilities
+    return policy
@@ -0,0 +1,117 @@
+"""
+Per-board aggregates of the steering recorded in a step log.
+
+The index holds, for every position key, the number of recorded steps and the mean, standard
+deviation and top k features by absolute mean steering. It is built from a StepLog and can be
+updated incrementally since the log is append-only: only rows added since the last update are read.
+
+Run `python feature_index.py <log directory> [<index directory>]` to build or update an index.
+"""
+import os, sys, json
+import numpy as np
+
+from board import NUM_KEYS, Board, board_key
+from recorder import StepLog
+
+TOP_K = 5
+
+def default_index_path(log_directory):
+    return log_directory.rstrip('/\\') + '_index'
+
+def _save(directory, name, array):
+    # Written to a temporary file first so that readers never see a partial array
+    path = os.path.join(directory, f'{name}.npy')
+    temporary_path = os.path.join(directory, f'{name}.tmp.npy')
+    np.save(temporary_path, array)
+    os.replace(temporary_path, path)
+
+def update_index(log_directory, index_directory=None, top_k=TOP_K, chunk_size=65536):
+    """
+    Adds the rows of the log that are not yet in the index, returns the number of rows added
+    """
+    index_directory = index_directory or default_index_path(log_directory)
+    os.makedirs(index_directory, exist_ok=True)
+    log = StepLog(log_directory)
+    num_features = len(log.labels)
+
+    meta_path = os.path.join(index_directory, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['uuids'] != log.uuids:
+            raise ValueError(f"{index_directory} was built from a log with different features")
+        count = np.load(os.path.join(index_directory, 'count.npy'))
+        total = np.load(os.path.join(index_directory, 'sum.npy'))
+        total_squared = np.load(os.path.join(index_directory, 'sum_squared.npy'))
+    else:
+        meta = {'labels': log.labels, 'uuids': log.uuids, 'rows': 0}
+        count = np.zeros(NUM_KEYS, dtype=np.int64)
+        total = np.zeros((NUM_KEYS, num_features))
+        total_squared = np.zeros((NUM_KEYS, num_features))
+
+    start = meta['rows']
+    if start == len(log):
+        return 0
+
+    for chunk in log.iter_chunks(chunk_size, start=start):
+        keys = np.asarray(chunk['board_key'], dtype=np.int64)
+        steering = np.asarray(chunk['steering'], dtype=np.float64)
+        np.add.at(count, keys, 1)
+        np.add.at(total, keys, steering)
+        np.add.at(total_squared, keys, steering ** 2)
+
+    seen = np.maximum(count, 1)[:, None]
+    mean = total / seen
+    std = np.sqrt(np.maximum(total_squared / seen - mean ** 2, 0))
+    top = np.argsort(-np.abs(mean), axis=1)[:, :top_k]
+
+    for name, array in [('count', count), ('sum', total), ('sum_squared', total_squared),
+                        ('mean', mean.astype(np.float32)), ('std', std.astype(np.float32)), ('top', top.astype(np.int16))]:
+        _save(index_directory, name, array)
+
+    added = len(log) - start
+    meta['rows'] = len(log)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return added
+
+class FeatureIndex:
+    """
+    Read side of an index, arrays are memory mapped on first use
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.labels = json.load(f)['labels']
+        self._arrays = {}
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.directory, f'{name}.npy'), mmap_mode='r')
+        return self._arrays[name]
+
+    def count(self, board):
+        return int(self._array('count')[board_key(board)])
+
+    def top_features(self, board, k=TOP_K):
+        """
+        Returns up to k (label, mean) pairs ordered by absolute mean, empty if the board was never seen
+        """
+        key = board_key(board)
+        if self._array('count')[key] == 0:
+            return []
+        mean = self._array('mean')[key]
+        return [(self.labels[i], float(mean[i])) for i in self._array('top')[key][:k]]
+
+    def board_states(self):
+        """
+        List form of every board with recorded steering
+        """
+        return [tuple(Board.from_key(int(key))) for key in np.flatnonzero(self._array('count'))]
+
+if __name__ == '__main__':
+    log_directory = sys.argv[1]
+    index_directory = sys.argv[2] if len(sys.argv) > 2 else None
+    added = update_index(log_directory, index_directory)
+    print(f"Added {added} steps to {index_directory or default_index_path(log_directory)}")
@@ -1,41 +1,117 @@
-from tictactoe import TicTacToeEnv, TicTacToeSAE
+from tictactoe import TicTacToeEnv, TicTacToeSAE, load_action_features
 from agents import OptimalAgent, RandomAgent, LLMAgent, RLAgent, add_statistic
 from move_checker import MoveChecker
+from recorder import StepRecorder
+from context import collect_context
 from utils import display_board
-import pickle
+from metrics import metrics, METRICS_DIR
+import os, time
 
 from tqdm import tqdm
-from constants import TEACHER, STUDENT, NUM_GAMES, NUM_ENVS
+from constants import TEACHER, STUDENT, NUM_GAMES, NUM_ENVS, RATE_LIMIT_PER_MINUTE
 
-from stable_baselines3.common.callbacks import CheckpointCallback
-from stable_baselines3.common.env_util import make_vec_env
-from stable_baselines3.common.vec_env import SubprocVecEnv
-from stable_baselines3.common.monitor import Monitor
+# stable_baselines3 and torch are imported by the functions that train, so that the
+# baseline experiments start without them
 
 def baseline_experiment(agent, env, num_games=NUM_GAMES):
     for _ in tqdm(range(num_games)):
         regular_game(agent, env)
         
-def saerl_learning(agent, env, num_steps):
+def saerl_learning(agent, env, num_steps, trace=False, checkpoint_dir="./output/checkpoints/exp10/"):
     
-    checkpoint_callback = CheckpointCallback(
+    from callbacks import TracingCallback, AsyncCheckpointCallback, MetricsCallback
+    
+    # Replay buffer rows are written incrementally on a background thread
+    checkpoint_callback = AsyncCheckpointCallback(
         save_freq=100,
-        save_path="./output/checkpoints/exp10/",
-        name_prefix="saerl_in_progress",
-        save_replay_buffer=True,
-        save_vecnormalize=True,
+        save_path=checkpoint_dir,
     )
     
+    # Collects the metrics of worker processes, a no-op for threaded environments
+    callbacks = [checkpoint_callback, MetricsCallback()]
+    
+    # Exports per step timings of the environments to tensorboard
+    if trace:
+        callbacks.append(TracingCallback())
+    
     agent.setup_model(env)
     
     if not agent.test_mode:
-        agent.model.learn(total_timesteps=num_steps, callback=checkpoint_callback, progress_bar=True)
+        agent.model.learn(total_timesteps=num_steps, callback=callbacks, progress_bar=True)
         agent.model.save("output/saerl_model_load_fix")
         agent.model.save_replay_buffer("output/saerl_replay_buffer_load_fix")
     else:
         for _ in tqdm(range(num_steps)):
             regular_game(agent, env)
 
+def offline_learning(agent, env, num_steps, replay_buffer_paths, step_log_directories, eval_episodes=5):
+    
+    from stable_baselines3.common.monitor import Monitor
+    from offline import load_transitions
+    
+    # Only the logs that exist are used
+    replay_buffer_paths = [path for path in replay_buffer_paths if os.path.exists(path)]
+    step_log_directories = [directory for directory in step_log_directories if os.path.exists(directory)]
+    
+    transitions = load_transitions(replay_buffer_paths, step_log_directories)
+    print(f"Training offline on {len(transitions['rewards'])} logged transitions")
+    
+    # The environment is only stepped for the periodic evaluation
+    agent.learn_offline(env, transitions, num_steps, eval_env=Monitor(env), eval_episodes=eval_episodes)
+    agent.model.save("output/saerl_model_offline")
+
+def exact_evaluation(agent, env, move_checker):
+    """
+    Exact results of the trained student against the teacher over every reachable board.
+    With free-form completions the move distributions are sampled, see evaluation.actor_policy.
+    """
+    from evaluation import evaluate_exact, actor_policy
+    
+    agent.setup_model(env)
+    results = evaluate_exact(actor_policy(agent.model, env), move_checker)
+    sampled = " (sampled move distributions)" if env.move_selection == 'completion' else ""
+    print(f"Win {results['wins']:.3f}, draw {results['draws']:.3f}, loss {results['losses']:.3f}, optimal moves {results['optimal_move_rate']:.3f} over {results['num_states']} boards{sampled}")
+    return results
+
+def forwarding_metrics(make_env):
+    """
+    Runs in a worker process, its metrics are sent with the step infos to the training process
+    """
+    metrics.forwarding = True
+    return make_env()
+
+def make_sae_envs(move_checker, teacher, num_envs=NUM_ENVS, test_agent=False, trace=False, action_features=None, threads=True, backend=None, rate_per_minute=RATE_LIMIT_PER_MINUTE):
+    """
+    Creates num_envs TicTacToeSAE environments, each wrapped in a MetricsMonitor.
+    With threads the environments are stepped on threads of this process and share the
+    backend and a rate limiter, otherwise each one runs in a worker process.
+    """
+    from callbacks import MetricsMonitor
+    from vec_env import make_subproc_vec_env, ThreadedVecEnv
+    
+    # Loaded once here rather than by every worker
+    if action_features is None:
+        action_features = load_action_features()
+    
+    if not threads:
+        return make_subproc_vec_env([
+            lambda i=i: forwarding_metrics(lambda: MetricsMonitor(TicTacToeSAE(move_checker, teacher, test_agent, trace=trace, backend=backend, action_features=action_features), env_id=i))
+            for i in range(num_envs)  # Creates X parallel environments
+        ])
+    
+    from backends import BudgetedBackend
+    from completions import BlockingTokenBucket
+    from utils import default_backend
+    
+    # One client and one request budget for all threads
+    backend = BudgetedBackend(backend if backend is not None else default_backend, BlockingTokenBucket(rate_per_minute))
+    
+    # Every environment gets its own teacher so that their random moves are independent
+    return ThreadedVecEnv([
+        lambda i=i: MetricsMonitor(TicTacToeSAE(move_checker, OptimalAgent(teacher.player, move_checker), test_agent, trace=trace, backend=backend, action_features=action_features), env_id=i)
+        for i in range(num_envs)
+    ])
+
 def regular_game(student, env, verbose=False):
     
     state, _ = env.reset()
@@ -58,28 +134,47 @@ def regular_game(student, env, verbose=False):
         
         state = new_state
 
-def run_experiment(num_games=NUM_GAMES, get_context=False, use_rl_agent=False, test_agent=False, use_checkpoint=False):
+def run_experiment(num_games=NUM_GAMES, get_context=False, use_rl_agent=False, test_agent=False, use_checkpoint=False, trace=False, offline=False, exact_eval=False, metrics_dir=METRICS_DIR):
+    
+    # Games, episodes, punishments and errors of the run go to one file, see metrics.py
+    run_directory = os.path.join(metrics_dir, time.strftime('%Y%m%d-%H%M%S'))
+    metrics.start(os.path.join(run_directory, 'events.jsonl'), tensorboard_dir=os.path.join(run_directory, 'tensorboard'))
     
     move_checker = MoveChecker()
     teacher = OptimalAgent(TEACHER, move_checker)
+    exact_results = None
     
     if use_rl_agent:
         student = RLAgent(STUDENT, test_mode=test_agent, use_checkpoint=use_checkpoint)
 
-        # Create X parallel environments
-        if NUM_ENVS == 1 or test_agent:
-            env = TicTacToeSAE(move_checker, teacher, test_agent)
+        # Trains on the saved replay buffer and step log, num_games is the number of gradient steps
+        if offline:
+            env = TicTacToeSAE(move_checker, teacher, trace=trace)
+            offline_learning(student, env, num_games, ["output/saerl_replay_buffer_load_fix.pkl"], ["output/step_log"])
+        # Walks the game tree instead of sampling num_games games, see evaluation.py
+        elif test_agent and exact_eval:
+            env = TicTacToeSAE(move_checker, teacher, test_agent, trace=trace)
+            exact_results = exact_evaluation(student, env, move_checker)
         else:
-            env = SubprocVecEnv([
-                lambda i=i: Monitor(TicTacToeSAE(move_checker, teacher, test_agent), filename=f"monitor_{i}.csv")
-                for i in range(NUM_ENVS)  # Creates X parallel environments
-            ])
-        
-        saerl_learning(student, env, num_games)
+            # Create X parallel environments
+            if NUM_ENVS == 1 or test_agent:
+                env = TicTacToeSAE(move_checker, teacher, test_agent, trace=trace)
+                
+                # Steering during evaluation is streamed to disk instead of kept in env.stats
+                if test_agent:
+                    env.recorder = StepRecorder('output/step_log', env.action_features)
+            else:
+                env = make_sae_envs(move_checker, teacher, NUM_ENVS, test_agent, trace=trace)
+            
+            saerl_learning(student, env, num_games, trace=trace)
     else:
         student = LLMAgent(STUDENT, get_context=get_context)
         env = TicTacToeEnv(move_checker, teacher)
         baseline_experiment(student, env, num_games)
+        
+        # Inspects the features behind every move played in the games above
+        if get_context:
+            collect_context(student)
     
     # Determines whether to use the context or not
     # The context takes a long time to generate
@@ -89,7 +184,10 @@ def run_experiment(num_games=NUM_GAMES, get_context=False, use_rl_agent=False, t
     
     # Expect to only use single environment for testing
     if test_agent:
-        results = env.results
+        results = exact_results if exact_results is not None else env.results
+        env.close()
+    
+    metrics.close()
     
     return student, env, results
 
@@ -0,0 +1,145 @@
+"""
+Structured metrics of a run: finished games, episodes, punishments, invalid answers, fallback
+moves, completion errors, requests given up after rate limiting and exported timings.
+
+Code on the hot path calls metrics.emit, which only puts the event on a bounded queue. A
+background thread takes the events off in batches and appends them to one JSON lines file,
+and to tensorboard if a directory is given. The sink is off until started, in which case
+emit returns immediately. A full queue drops events instead of blocking the step, the number
+of dropped events is written when the sink is closed.
+
+Episodes are reported by callbacks.MetricsMonitor. Events from SubprocVecEnv workers are
+collected in the worker with forwarding on and sent through the step info, and
+callbacks.MetricsCallback puts them into the sink of the training process.
+"""
+import os, json, time, queue, threading
+
+METRICS_DIR = 'output/metrics'
+
+class MetricsSink:
+    """
+    Args:
+        max_queue: Events held in memory before new ones are dropped
+        batch_size: Largest number of events written at once
+        flush_interval: Seconds the writer waits for a batch to fill
+    """
+
+    def __init__(self, max_queue=10_000, batch_size=512, flush_interval=1.0):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = None
+        self.thread = None
+        self.dropped = 0
+
+        # Set in SubprocVecEnv workers, events are kept in pending until drained into the step info
+        self.forwarding = False
+        self.pending = []
+
+    @property
+    def enabled(self):
+        return self.queue is not None or self.forwarding
+
+    def start(self, path, tensorboard_dir=None):
+        """
+        Starts writing events to path, closing the previous file if there was one
+        """
+        self.close()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.tensorboard_dir = tensorboard_dir
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=self.max_queue)
+        self.thread = threading.Thread(target=self._write_loop, args=(self.queue,), name='metrics', daemon=True)
+        self.thread.start()
+
+    def emit(self, kind, **fields):
+        if self.queue is None and not self.forwarding:
+            return
+        self.put({'kind': kind, 'time': time.time(), **fields})
+
+    def put(self, event):
+        if self.queue is None:
+            if self.forwarding:
+                self.pending.append(event)
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def drain(self):
+        """
+        Returns the events kept while forwarding and clears them
+        """
+        events, self.pending = self.pending, []
+        return events
+
+    def _write_loop(self, events):
+        writer = None
+        if self.tensorboard_dir is not None:
+            # Imported on the writer thread, only runs that log to tensorboard pay for torch
+            from torch.utils.tensorboard import SummaryWriter
+            writer = SummaryWriter(self.tensorboard_dir)
+        steps = {}
+
+        with open(self.path, 'a') as f:
+            while True:
+                batch = [events.get()]
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size and batch[-1] is not None:
+                    try:
+                        batch.append(events.get(timeout=max(0.0, deadline - time.monotonic())))
+                    except queue.Empty:
+                        break
+
+                done = batch[-1] is None
+                batch = [event for event in batch if event is not None]
+                f.write(''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in batch))
+                f.flush()
+
+                if writer is not None:
+                    for event in batch:
+                        self._write_scalars(writer, event, steps)
+                    writer.flush()
+
+                if done:
+                    break
+
+        if writer is not None:
+            writer.close()
+
+    def _write_scalars(self, writer, event, steps):
+        # Numeric fields are plotted against the number of events of their kind
+        kind = event['kind']
+        step = steps[kind] = steps.get(kind, 0) + 1
+        for name, value in event.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and name not in ('time', 'env'):
+                writer.add_scalar(f"metrics/{kind}_{name}", value, step)
+
+        # Running totals of the results, against the number of finished games
+        if kind == 'game':
+            result = f"result_{event['result']}"
+            steps[result] = steps.get(result, 0) + 1
+            writer.add_scalar(f"metrics/{result}", steps[result], step)
+
+    def close(self):
+        """
+        Writes every queued event and stops the writer
+        """
+        if self.queue is None:
+            return
+        if self.dropped:
+            self.put({'kind': 'dropped', 'time': time.time(), 'count': self.dropped})
+
+        # The end marker is the one item that is never dropped
+        self.queue.put(None)
+        self.thread.join()
+        self.queue = None
+        self.thread = None
+
+# Shared by everything in this process, started by run_experiment
+metrics = MetricsSink()
@@ -0,0 +1,200 @@
+"""
+Resumable mining of the feature candidates that TicTacToeSAE steers.
+
+Every board the student can face is shown to the unsteered model, the answer is inspected
+and the top features of the move token are appended to a JSON lines shard through
+context.ContextCollector. Each worker mines a disjoint slice of the boards into its own
+shard, and boards already in a shard are skipped, so workers can run as separate processes
+and be stopped and resumed without repeating API calls.
+
+merge_shards folds the shards into counts and activation statistics for every feature seen
+and writes them to a versioned candidates file, together with the Counter in results.pkl
+that TicTacToeSAE loads. Since every feature is kept, changing NUM_ACTIONS_SAE only changes
+how many are taken from the top.
+
+    python mining.py --worker 0 --num-workers 4   # one per process
+    python mining.py --merge
+"""
+import os, json, glob, uuid, pickle, asyncio, argparse
+from collections import Counter
+import numpy as np
+import goodfire
+
+from board import Board
+from constants import MODEL, STUDENT, RATE_LIMIT_PER_MINUTE
+from completions import AsyncCompleter, TokenBucket
+from context import ContextCollector, read_context
+from prompting import prompt_builder
+from utils import check_move, default_backend
+
+MINING_DIRECTORY = 'output/mining'
+CANDIDATES_PATH = 'output/mining/candidates.json'
+RESULTS_PATH = 'output/results.pkl'
+
+# Bumped whenever the layout of the candidates file changes
+CANDIDATES_VERSION = 1
+
+def student_boards():
+    """
+    Returns every board where the student is to move, in key order.
+    The teacher moves first, so these hold one more X than O and nobody has won yet.
+    """
+    boards = []
+    for key in range(3 ** 9):
+        board = Board.from_key(key)
+        num_x, num_o = bin(board.x).count('1'), bin(board.o).count('1')
+        if num_x == num_o + 1 and board.winner() is None and not board.is_full():
+            boards.append(board)
+    return boards
+
+def shard_path(directory, worker):
+    return os.path.join(directory, f"shard_{worker}.jsonl")
+
+def mining_pair(board, sample):
+    return f"{board.key}#{sample}"
+
+class FeatureMiner:
+    """
+    Args:
+        backend: Backend used for completions and inspection
+        directory: Directory holding one shard per worker
+        worker: Index of this worker, it mines every num_workers-th board starting at worker
+        num_workers: Number of workers the boards are split between
+        samples: Number of answers inspected per board
+        completer: AsyncCompleter shared by completions and inspection, its rate limit is
+            split between the workers when it is not given
+        k: Number of top features kept per answer
+    """
+
+    def __init__(self, backend=None, directory=MINING_DIRECTORY, worker=0, num_workers=1, samples=1, completer=None, k=5):
+        self.backend = backend if backend is not None else default_backend
+        self.model = self.backend.variant(MODEL)
+        self.worker = worker
+        self.num_workers = num_workers
+        self.samples = samples
+
+        if completer is None:
+            completer = AsyncCompleter(self.backend, rate_limiter=TokenBucket(RATE_LIMIT_PER_MINUTE / num_workers))
+        self.completer = completer
+        self.collector = ContextCollector(self.backend, shard_path(directory, worker), completer, k)
+        self.prompts = prompt_builder()
+
+    def pending(self):
+        """
+        Returns the (board, sample) pairs of this worker that are not in its shard yet
+        """
+        done = self.collector.completed()
+        return [
+            (board, sample)
+            for board in student_boards()[self.worker::self.num_workers]
+            for sample in range(self.samples)
+            if mining_pair(board, sample) not in done
+        ]
+
+    async def _answer(self, board, sample):
+        api_format = self.prompts.api_format(board, STUDENT)
+
+        # Rate limit errors propagate so the pair is asked again on the next run
+        response = await self.completer.complete(self.model, api_format)
+        api_format['assistant']['content'] = response
+
+        try:
+            move = check_move(board, response)
+        except Exception:
+            move = None
+
+        return {'state': tuple(board), 'move': move, 'api_format': api_format, 'pair': mining_pair(board, sample)}
+
+    async def _answers(self, batch):
+        results = await asyncio.gather(*[self._answer(board, sample) for board, sample in batch], return_exceptions=True)
+        items = []
+        for result in results:
+            if isinstance(result, Exception):
+                print("Error getting completion", result)
+            else:
+                items.append(result)
+        return items
+
+    def mine(self, batch_size=64):
+        """
+        Mines the pending pairs in batches and returns how many were written.
+        Each batch is appended to the shard before the next one starts.
+        """
+        pending = self.pending()
+        written = 0
+        for start in range(0, len(pending), batch_size):
+            items = self.completer.loop.run_until_complete(self._answers(pending[start:start + batch_size]))
+            written += self.collector.collect(self.model, items)
+        return written
+
+def merge_shards(directory=MINING_DIRECTORY, path=CANDIDATES_PATH, results_path=RESULTS_PATH):
+    """
+    Folds every shard in directory into per feature statistics and writes the candidates file
+    and results.pkl. Returns the candidates sorted by count.
+    """
+    features = {}
+    activations = {}
+    boards = {}
+    num_records = 0
+
+    for shard in sorted(glob.glob(os.path.join(directory, 'shard_*.jsonl'))):
+        for record in read_context(shard):
+            num_records += 1
+            for feature in record['features']:
+                features.setdefault(feature['uuid'], feature)
+                activations.setdefault(feature['uuid'], []).append(feature['activation'])
+                boards.setdefault(feature['uuid'], set()).add(record['board_key'])
+
+    candidates = []
+    for feature_uuid, feature in features.items():
+        values = np.array(activations[feature_uuid], dtype=float)
+        candidates.append({
+            'uuid': feature_uuid,
+            'label': feature['label'],
+            'index_in_sae': feature['index_in_sae'],
+            'count': len(values),
+            'boards': len(boards[feature_uuid]),
+            'mean_activation': float(values.mean()),
+            'std_activation': float(values.std()),
+            'max_activation': float(values.max()),
+        })
+    candidates.sort(key=lambda candidate: (-candidate['count'], -candidate['mean_activation']))
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'version': CANDIDATES_VERSION, 'model': MODEL, 'records': num_records, 'candidates': candidates}, f, indent=1)
+
+    # Counter of features in the layout TicTacToeSAE expects
+    counter = Counter({
+        goodfire.Feature(uuid.UUID(candidate['uuid']), candidate['label'], candidate['index_in_sae']): candidate['count']
+        for candidate in candidates
+    })
+    with open(results_path, 'wb') as f:
+        pickle.dump(counter, f)
+
+    return candidates
+
+def load_candidates(path=CANDIDATES_PATH):
+    with open(path) as f:
+        data = json.load(f)
+    if data['version'] != CANDIDATES_VERSION:
+        raise ValueError(f"{path} has version {data['version']}, expected {CANDIDATES_VERSION}, run python mining.py --merge again")
+    return data['candidates']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mine the feature candidates steered by TicTacToeSAE")
+    parser.add_argument('--worker', type=int, default=0)
+    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--samples', type=int, default=1, help="Answers inspected per board")
+    parser.add_argument('--directory', default=MINING_DIRECTORY)
+    parser.add_argument('--merge', action='store_true', help="Merge the shards into the candidates file and results.pkl")
+    args = parser.parse_args()
+
+    if args.merge:
+        candidates = merge_shards(args.directory)
+        print(f"Merged {len(candidates)} candidates into {CANDIDATES_PATH} and {RESULTS_PATH}")
+    else:
+        miner = FeatureMiner(directory=args.directory, worker=args.worker, num_workers=args.num_workers, samples=args.samples)
+        print(f"Worker {args.worker} wrote {miner.mine()} records to {miner.collector.path}")
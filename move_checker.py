@@ -1,60 +1,106 @@
+from board import as_board, MASK_TO_MOVES
+from symmetry import canonicalize, from_canonical_move
+from solver import load_table, open_search_table, empty_table, player_index, SOLVED_TABLE_PATH, SEARCH_TABLE_PATH, UNSOLVED
+
 class MoveChecker:
-    
-    def __init__(self):
-        self.hash_table = {
-            "X": {},
-            "O": {}
-        }
-        
+
+    def __init__(self, table_path=SOLVED_TABLE_PATH, search_table_path=SEARCH_TABLE_PATH):
+        self.table_path = table_path
+        self.search_table_path = search_table_path
+        self._open()
+
+    def _open(self):
+        # Solved positions are looked up from the precomputed table
+        self.table = load_table(self.table_path)
+
+        # Opened on the first search, the solved table covers every reachable position
+        self._search_table = None
+
+    @property
+    def search_table(self):
+        # Fallback for positions outside the table, e.g. boards that cannot occur in play
+        if self._search_table is None:
+            try:
+                self._search_table = open_search_table(self.search_table_path)
+            except OSError:
+                # e.g. a read-only checkout, searches are then only kept by this process
+                self._search_table = empty_table()
+        return self._search_table
+
+    def __getstate__(self):
+        # SubprocVecEnv pickles the checker into every worker, only the paths are sent
+        # and each worker maps the same files instead of receiving a copy of the tables
+        return {'table_path': self.table_path, 'search_table_path': self.search_table_path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
     def is_optimal_move(self, board, action, player):
-        board_key = tuple(board)
-        if board_key in self.hash_table[player]:
-            optimal_moves = self.hash_table[player][board_key]
-        else:
-            optimal_moves = self.get_optimal_moves(board, player)
-            self.hash_table[player][board_key] = optimal_moves
-        
-        return action in optimal_moves
+        return action in self.get_optimal_moves(board, player)
 
     def get_optimal_moves(self, board, player):
-        
-        board_key = tuple(board)
-        if board_key in self.hash_table[player]:
-            return self.hash_table[player][board_key]
-        
+        board = as_board(board)
+        entry = self.table[player_index(player), board.key]
+        if entry['value'] != UNSOLVED:
+            return MASK_TO_MOVES[entry['moves']]
+
+        return self.search_optimal_moves(board, player)
+
+    def get_value(self, board, player):
+        """
+        Returns the game value for the player to move: 1 for a win, 0 for a draw and -1 for a loss
+        Returns None if the position is terminal or not in the table
+        """
+        value = self.table[player_index(player), as_board(board).key]['value']
+        return None if value == UNSOLVED else int(value)
+
+    def search_optimal_moves(self, board, player):
+
+        # Searched on the canonical board, so the 8 symmetric boards share one search and one entry
+        board, symmetry = canonicalize(as_board(board))
+        entry = self.search_table[player_index(player), board.key]
+        if entry['value'] != UNSOLVED:
+            return [from_canonical_move(move, symmetry) for move in MASK_TO_MOVES[entry['moves']]]
+
         best_score = None
         optimal_moves = []
-        for move in self.available_moves(board):
-            board_copy = board.copy()
-            board_copy[move] = player
-            score = self.minimax(board_copy, self.swap_player(player), False)
+        for move in board.legal_moves():
+            board.place(move, player)
+            score = self.minimax(board, self.swap_player(player), False)
+            board.remove(move)
             if best_score is None or score > best_score:
                 best_score = score
                 optimal_moves = [move]
             elif score == best_score:
                 optimal_moves.append(move)
-                
-        self.hash_table[player][board_key] = optimal_moves
-        return optimal_moves
+
+        # Terminal boards have no moves and are left unsolved
+        if best_score is not None:
+            # The value is written last so other processes never read moves that are not written yet
+            index = player_index(player), board.key
+            self.search_table['moves'][index] = sum(1 << move for move in optimal_moves)
+            self.search_table['value'][index] = best_score
+        return [from_canonical_move(move, symmetry) for move in optimal_moves]
 
     def minimax(self, board, player, is_maximizing):
         original_player = self.swap_player(player) if not is_maximizing else player
 
         def minimax_recursion(board, player, is_maximizing, alpha, beta):
-            winner = self.check_winner(board)
+            winner = board.winner()
             if winner == original_player:
                 return 1
             elif winner == self.swap_player(original_player):
                 return -1
-            elif self.is_board_full(board):
+            elif board.is_full():
                 return 0
-            
+
             if is_maximizing:
                 max_eval = float('-inf')
-                for move in self.available_moves(board):
-                    board[move] = player
+                for move in board.legal_moves():
+                    board.place(move, player)
                     eval = minimax_recursion(board, self.swap_player(player), False, alpha, beta)
-                    board[move] = None
+                    board.remove(move)
                     max_eval = max(max_eval, eval)
                     alpha = max(alpha, eval)
                     if beta <= alpha:
@@ -62,35 +108,26 @@ class MoveChecker:
                 return max_eval
             else:
                 min_eval = float('inf')
-                for move in self.available_moves(board):
-                    board[move] = player
+                for move in board.legal_moves():
+                    board.place(move, player)
                     eval = minimax_recursion(board, self.swap_player(player), True, alpha, beta)
-                    board[move] = None
+                    board.remove(move)
                     min_eval = min(min_eval, eval)
                     beta = min(beta, eval)
                     if beta <= alpha:
                         break
                 return min_eval
 
-        return minimax_recursion(board, player, is_maximizing, float('-inf'), float('inf'))
+        return minimax_recursion(as_board(board), player, is_maximizing, float('-inf'), float('inf'))
 
     def available_moves(self, board):
-        return [i for i, spot in enumerate(board) if spot not in ['X', 'O']]
+        return list(as_board(board).legal_moves())
 
     def check_winner(self, board):
-        winning_combinations = [
-            [0,1,2], [3,4,5], [6,7,8],  # rows
-            [0,3,6], [1,4,7], [2,5,8],  # columns
-            [0,4,8], [2,4,6]            # diagonals
-        ]
-        for combo in winning_combinations:
-            a, b, c = combo
-            if board[a] == board[b] == board[c] and board[a] in ['X', 'O']:
-                return board[a]
-        return None
+        return as_board(board).winner()
 
     def is_board_full(self, board):
-        return all(spot in ['X', 'O'] for spot in board)
+        return as_board(board).is_full()
 
     def swap_player(self, player):
-        return 'O' if player == 'X' else 'X'
\ No newline at end of file
+        return 'O' if player == 'X' else 'X'
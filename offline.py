@@ -0,0 +1,191 @@
+"""
+Transitions for training SAC without calling the environment.
+
+Transitions come from replay buffers saved with save_replay_buffer and from step logs
+written by a StepRecorder. They are merged, exact duplicates are dropped and the result is
+packed into a ReplayBuffer that RLAgent.learn_offline samples from.
+
+Step logs do not hold the next board, it is taken from the following row when that row
+continues the same game. Otherwise the game ended after the step and it is marked done.
+The last row of a log is dropped unless the student's move ended its game, since the log
+may have stopped mid-game. Rows without a reward, e.g. logs converted from features.pkl,
+are skipped.
+
+The same step can be both in a replay buffer and in a step log. The two copies differ in the
+float32 rounding of the action and, on the last step of a game, in the next board, so
+duplicates are found on rounded actions and without the next board of done rows.
+
+Transitions can be augmented with the symmetric copies of their boards, see
+symmetric_transitions and SymmetricReplayBuffer. The steering action is kept as it is,
+which treats the steered model as answering a rotated board with the rotated move.
+"""
+import numpy as np
+from stable_baselines3.common.buffers import ReplayBuffer
+from stable_baselines3.common.save_util import load_from_pkl
+
+from board import KEY_CELLS, KEY_OUTCOMES
+from constants import STEERING_BOUND
+from recorder import StepLog
+from symmetry import NUM_SYMMETRIES, PERMUTATIONS, symmetric_observations
+
+def empty_transitions(num_features):
+    return {
+        'observations': np.zeros((0, 9), dtype=np.float32),
+        'actions': np.zeros((0, num_features), dtype=np.float32),
+        'rewards': np.zeros(0, dtype=np.float32),
+        'next_observations': np.zeros((0, 9), dtype=np.float32),
+        'dones': np.zeros(0, dtype=np.float32),
+    }
+
+def replay_buffer_transitions(path):
+    """
+    Returns the filled rows of a pickled ReplayBuffer, one row per environment step
+    """
+    buffer = load_from_pkl(path)
+    size = buffer.buffer_size if buffer.full else buffer.pos
+
+    def rows(array):
+        return array[:size].reshape(size * buffer.n_envs, *array.shape[2:])
+
+    # Time limit truncations are not terminal, SB3 masks them the same way when sampling
+    dones = buffer.dones[:size] * (1 - buffer.timeouts[:size])
+
+    # Buffers saved with optimize_memory_usage keep the next observation in the following row
+    if buffer.optimize_memory_usage:
+        next_observations = buffer.observations[(np.arange(size) + 1) % buffer.buffer_size]
+    else:
+        next_observations = buffer.next_observations[:size]
+
+    return {
+        'observations': rows(buffer.observations).astype(np.float32),
+        'actions': rows(buffer.actions).astype(np.float32),
+        'rewards': rows(buffer.rewards).astype(np.float32),
+        'next_observations': next_observations.reshape(size * buffer.n_envs, -1).astype(np.float32),
+        'dones': rows(dones).astype(np.float32),
+    }
+
+def step_log_transitions(directory, steering_bound=STEERING_BOUND):
+    """
+    Returns the transitions recorded in a step log. Actions are scaled to [-1, 1] like
+    the actions SAC stores in its replay buffer.
+    """
+    log = StepLog(directory)
+    keys = np.asarray(log['board_key'], dtype=np.int64)
+    moves = np.asarray(log['move'], dtype=np.int64)
+    rewards = np.asarray(log['reward'], dtype=np.float32)
+    steering = np.asarray(log['steering'], dtype=np.float32)
+
+    if len(keys) == 0:
+        return empty_transitions(len(log.labels))
+
+    # The board after the student's move, before the teacher replies
+    after_move = keys + 2 * 3 ** np.maximum(moves, 0)
+
+    # The next row continues the game if its board holds every piece of this board and the move
+    cells_after = KEY_CELLS[after_move[:-1]]
+    cells_next = KEY_CELLS[keys[1:]]
+    continues = np.append(((cells_after == 0) | (cells_after == cells_next)).all(axis=1), False)
+
+    next_keys = np.where(continues, np.append(keys[1:], 0), after_move)
+    valid = ~np.isnan(rewards) & (moves >= 0)
+
+    # A log can stop mid-game, the last row is only kept if the student's move ended the game
+    valid[-1] &= KEY_OUTCOMES[after_move[-1]] != 0
+
+    return {
+        'observations': KEY_CELLS[keys[valid]].astype(np.float32),
+        'actions': np.clip(steering[valid] / steering_bound, -1, 1),
+        'rewards': rewards[valid],
+        'next_observations': KEY_CELLS[next_keys[valid]].astype(np.float32),
+        'dones': (~continues[valid]).astype(np.float32),
+    }
+
+# Decimals actions are compared on, coarser than the float32 rounding of a step log
+ACTION_DECIMALS = 5
+
+def merge_transitions(transitions):
+    """
+    Concatenates transition dicts and drops duplicates, keeping the first copy, see the module docstring
+    """
+    transitions = [t for t in transitions if len(t['rewards'])]
+    if not transitions:
+        raise ValueError("No transitions to merge")
+
+    names = list(transitions[0])
+    merged = {name: np.concatenate([t[name] for t in transitions]).astype(np.float32) for name in names}
+    num_rows = len(merged['rewards'])
+
+    done = merged['dones'].reshape(num_rows, 1) > 0
+    compared = {
+        **merged,
+        'actions': np.round(merged['actions'], ACTION_DECIMALS),
+        'next_observations': np.where(done, 0, merged['next_observations'].reshape(num_rows, -1)),
+    }
+
+    # Rows are compared on every field at once
+    rows = np.concatenate([compared[name].reshape(num_rows, -1) for name in names], axis=1)
+    _, unique = np.unique(rows, axis=0, return_index=True)
+    unique.sort()
+    return {name: merged[name][unique] for name in names}
+
+def symmetric_transitions(transitions):
+    """
+    Returns the transitions with the 8 symmetric copies of each board, copies that are
+    identical, e.g. of the empty board, are dropped by merge_transitions
+    """
+    def repeat(array):
+        return np.concatenate([array] * NUM_SYMMETRIES)
+
+    return {
+        'observations': symmetric_observations(transitions['observations']).reshape(-1, 9),
+        'actions': repeat(transitions['actions']),
+        'rewards': repeat(transitions['rewards']),
+        'next_observations': symmetric_observations(transitions['next_observations']).reshape(-1, 9),
+        'dones': repeat(transitions['dones']),
+    }
+
+def load_transitions(replay_buffer_paths=(), step_log_directories=(), symmetric=False):
+    transitions = [replay_buffer_transitions(path) for path in replay_buffer_paths]
+    transitions += [step_log_transitions(directory) for directory in step_log_directories]
+    if symmetric:
+        transitions = [symmetric_transitions(t) for t in transitions]
+    return merge_transitions(transitions)
+
+class SymmetricReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer that stores every real transition together with its 7 symmetric copies.
+    Pass it as replay_buffer_class to SAC, see RLAgent's symmetric_replay.
+    """
+
+    # Rows added per environment step, used by AsyncCheckpointCallback
+    copies_per_step = NUM_SYMMETRIES
+
+    def add(self, obs, next_obs, action, reward, done, infos):
+        for permutation in PERMUTATIONS:
+            super().add(obs[..., permutation], next_obs[..., permutation], action, reward, done, infos)
+
+def build_replay_buffer(transitions, observation_space, action_space, buffer_size=None):
+    """
+    Packs transitions into a ReplayBuffer for a single environment
+    """
+    size = len(transitions['rewards'])
+    if transitions['actions'].shape[1:] != action_space.shape:
+        raise ValueError(f"Transitions have actions of shape {transitions['actions'].shape[1:]}, the action space is {action_space.shape}")
+
+    buffer = ReplayBuffer(
+        max(size, buffer_size or 0),
+        observation_space,
+        action_space,
+        device='cpu',
+        n_envs=1,
+        handle_timeout_termination=False,
+    )
+    buffer.observations[:size, 0] = transitions['observations']
+    buffer.next_observations[:size, 0] = transitions['next_observations']
+    buffer.actions[:size, 0] = transitions['actions']
+    buffer.rewards[:size, 0] = transitions['rewards']
+    buffer.dones[:size, 0] = transitions['dones']
+
+    buffer.pos = size % buffer.buffer_size
+    buffer.full = size == buffer.buffer_size
+    return buffer
@@ -0,0 +1,99 @@
+"""
+Prompt templates loaded once and rendered once per board.
+
+The templates in prompts/ are read and validated the first time they are needed. The user
+message for each (board, player) pair is rendered on first use and kept, so later requests
+for the same board reuse the same message objects instead of copying and formatting the
+template. The system message is a single shared object, which keeps the long few-shot prefix
+byte-identical across every request.
+
+Messages are shared between callers, so they are handed out as read-only mappings. Only the
+assistant message of an api_format is created per call and can be filled in. Backends copy the
+messages into plain dicts before sending them to the API.
+"""
+import string
+from types import MappingProxyType
+from functools import lru_cache
+
+from board import as_board
+
+SYSTEM_PROMPT_PATH = 'prompts/system_prompt.txt'
+USER_PROMPT_PATH = 'prompts/user_prompt.txt'
+
+# Fields the user prompt is formatted with
+USER_PROMPT_FIELDS = {'board', 'player_type'}
+
+def render_board(board):
+    """
+    Minimal representation of the board
+    """
+    board = list(board)
+    return '\n'.join(' '.join(map(str, board[i*3:i*3+3])) for i in range(3))
+
+def validate_template(template, fields):
+    found = {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+    if found != fields:
+        raise ValueError(f"Prompt template expects the fields {sorted(fields)}, found {sorted(found)}")
+
+class PromptBuilder:
+    """
+    Args:
+        system_path: File holding the system prompt
+        user_path: File holding the user prompt, formatted with the board and the player
+    """
+
+    def __init__(self, system_path=SYSTEM_PROMPT_PATH, user_path=USER_PROMPT_PATH):
+        self.system_path = system_path
+        self.user_path = user_path
+        
+        with open(system_path, 'r') as f:
+            system_prompt = f.read()
+
+        with open(user_path, 'r') as f:
+            self.user_template = f.read()
+
+        validate_template(self.user_template, USER_PROMPT_FIELDS)
+
+        self.system_message = MappingProxyType({"role": "system", "content": system_prompt})
+        self.user_messages = {}
+
+    def __reduce__(self):
+        # Read-only mappings cannot be pickled, workers use the builder of their own process
+        return prompt_builder, (self.system_path, self.user_path)
+
+    def user_message(self, board, player):
+        board = as_board(board)
+        key = (player, board.key)
+        message = self.user_messages.get(key)
+        if message is None:
+            content = self.user_template.format(board=render_board(board), player_type=player)
+            message = MappingProxyType({"role": "user", "content": content})
+            self.user_messages[key] = message
+        return message
+
+    def messages(self, board, player):
+        """
+        Returns the (system, user) messages sent to the model for the board
+        """
+        return self.system_message, self.user_message(board, player)
+
+    def api_format(self, board, player):
+        """
+        Returns the prompt in the api_format layout used by get_valid_move, the assistant
+        message is left empty for the response
+        """
+        return {
+            'system': self.system_message,
+            'user': self.user_message(board, player),
+            'assistant': {"role": "assistant", "content": None}
+        }
+
+def prompt_builder(system_path=SYSTEM_PROMPT_PATH, user_path=USER_PROMPT_PATH):
+    """
+    Returns the builder shared by every agent and environment in the process
+    """
+    return _shared_builder(system_path, user_path)
+
+@lru_cache(maxsize=None)
+def _shared_builder(system_path, user_path):
+    return PromptBuilder(system_path, user_path)
@@ -0,0 +1,157 @@
+"""
+Append-only columnar log of the steering applied at every environment step.
+
+Each column is a raw binary file that rows are appended to in chunks, so memory use stays
+flat during long runs and the log can be memory mapped while it is still being written.
+Feature labels are stored once in meta.json rather than with every step.
+
+Layout of a log directory:
+    meta.json       feature labels and uuids, column dtypes
+    board_key.bin   int32 position key of the board the student moved on
+    steering.bin    float32 steering value per feature
+    move.bin        int8 move that was played
+    reward.bin      float32 reward of the step, NaN if unknown
+    flags.bin       uint8 bit flags, see FLAG_FALLBACK and FLAG_MINOR_PUNISH
+"""
+import os, json, pickle
+import numpy as np
+
+from board import board_key
+
+FLAG_FALLBACK = 1 # No valid move was returned, a random move was played
+FLAG_MINOR_PUNISH = 2 # The last answer was an occupied cell
+
+COLUMNS = {
+    'board_key': np.int32,
+    'move': np.int8,
+    'reward': np.float32,
+    'flags': np.uint8,
+}
+
+class StepRecorder:
+    """
+    Args:
+        directory: Directory of the log, created if needed. Existing logs are appended to.
+        features: Steered features, their labels are written to meta.json
+        chunk_size: Number of steps buffered in memory between writes
+
+    A log has a single writer, the recorder cannot be pickled into other processes.
+    """
+
+    def __init__(self, directory, features, chunk_size=1024):
+        self.directory = directory
+        self.num_features = len(features)
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+
+        meta_path = os.path.join(directory, 'meta.json')
+        meta = {
+            'labels': [feature.label for feature in features],
+            'uuids': [str(feature.uuid) for feature in features],
+            'columns': {name: np.dtype(dtype).str for name, dtype in COLUMNS.items()},
+            'steering_dtype': np.dtype(np.float32).str,
+        }
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                if json.load(f)['uuids'] != meta['uuids']:
+                    raise ValueError(f"{directory} already holds a log for different features")
+        else:
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+
+        self.buffers = {name: np.zeros(chunk_size, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.steering = np.zeros((chunk_size, self.num_features), dtype=np.float32)
+        self.size = 0
+
+    def __getstate__(self):
+        # Columns are appended to in separate writes, so two processes flushing into one log
+        # could interleave their chunks differently in each file and mix up the rows
+        raise TypeError("A StepRecorder can only be used by the process that created it, "
+                        "create one with its own directory in every worker instead")
+
+    def record(self, key, steering, move, reward=np.nan, flags=0):
+        """
+        Appends one step, key is the position key of the board before the move
+        """
+        row = self.size
+        self.buffers['board_key'][row] = key
+        self.buffers['move'][row] = move
+        self.buffers['reward'][row] = reward
+        self.buffers['flags'][row] = flags
+        self.steering[row] = steering
+        self.size += 1
+
+        if self.size == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.size == 0:
+            return
+
+        for name, buffer in self.buffers.items():
+            with open(os.path.join(self.directory, f'{name}.bin'), 'ab') as f:
+                f.write(buffer[:self.size].tobytes())
+        with open(os.path.join(self.directory, 'steering.bin'), 'ab') as f:
+            f.write(self.steering[:self.size].tobytes())
+        self.size = 0
+
+    def close(self):
+        self.flush()
+
+class StepLog:
+    """
+    Read side of a StepRecorder directory, every column is memory mapped
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.labels = meta['labels']
+        self.uuids = meta['uuids']
+
+        self.columns = {name: self._map(name, np.dtype(dtype)) for name, dtype in meta['columns'].items()}
+        steering = self._map('steering', np.dtype(meta['steering_dtype']))
+        self.columns['steering'] = steering[:len(steering) - len(steering) % len(self.labels)].reshape(-1, len(self.labels))
+
+        # A chunk may be partially written while the log is being recorded
+        num_rows = min(len(column) for column in self.columns.values())
+        self.columns = {name: column[:num_rows] for name, column in self.columns.items()}
+
+    def _map(self, name, dtype):
+        path = os.path.join(self.directory, f'{name}.bin')
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return len(self.columns['board_key'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def iter_chunks(self, chunk_size=65536, start=0):
+        """
+        Yields dicts of column slices, starting from row start
+        """
+        for begin in range(start, len(self), chunk_size):
+            yield {name: column[begin:begin + chunk_size] for name, column in self.columns.items()}
+
+def convert_activations_pickle(pickle_path, directory):
+    """
+    Converts a pickled stats['activations'] dict, e.g. output/features.pkl, into a step log.
+    Moves and rewards were not recorded in that format and are stored as -1 and NaN.
+    """
+    with open(pickle_path, 'rb') as f:
+        activations = pickle.load(f)
+
+    recorder = None
+    for board, actions in activations.items():
+        for action in actions:
+            if recorder is None:
+                recorder = StepRecorder(directory, [feature for feature, _ in action])
+            recorder.record(board_key(board), [value for _, value in action], -1)
+
+    if recorder is not None:
+        recorder.close()
+    return recorder
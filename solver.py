@@ -0,0 +1,115 @@
+"""
+Offline perfect-play solver for tic-tac-toe.
+
+Walks every position reachable from the empty board (with either player moving first)
+and stores, for each (player to move, board) pair, the set of optimal moves and the
+game value from the mover's perspective. The table is indexed by the base 3 board key
+so lookups are a single array access.
+
+Run `python solver.py` to regenerate the table on disk.
+"""
+import os
+import numpy as np
+from board import Board
+
+SOLVED_TABLE_PATH = 'output/solved_table.npy'
+SEARCH_TABLE_PATH = 'output/search_table.npy'
+
+PLAYERS = ('X', 'O')
+NUM_POSITIONS = 3 ** 9
+
+# moves is a 9 bit mask of optimal moves, value is 1 (win), 0 (draw) or -1 (loss)
+TABLE_DTYPE = np.dtype([('moves', np.uint16), ('value', np.int8)])
+UNSOLVED = -2
+
+def player_index(player):
+    return 0 if player == 'X' else 1
+
+def _solve(board, player, table):
+    """
+    Negamax over the game tree, filling table with every position it visits
+    """
+    key = board.key
+    entry = table[player_index(player), key]
+    if entry['value'] != UNSOLVED:
+        return int(entry['value'])
+
+    opponent = 'O' if player == 'X' else 'X'
+    best_score = None
+    optimal_mask = 0
+    for move in board.legal_moves():
+        board.place(move, player)
+        if board.winner() == player:
+            score = 1
+        elif board.is_full():
+            score = 0
+        else:
+            score = -_solve(board, opponent, table)
+        board.remove(move)
+
+        if best_score is None or score > best_score:
+            best_score = score
+            optimal_mask = 1 << move
+        elif score == best_score:
+            optimal_mask |= 1 << move
+
+    table[player_index(player), key] = (optimal_mask, best_score)
+    return best_score
+
+def solve_all():
+    """
+    Returns a table of shape (2, 3**9) covering every reachable position.
+    Terminal and unreachable positions keep the UNSOLVED value.
+    """
+    table = np.zeros((len(PLAYERS), NUM_POSITIONS), dtype=TABLE_DTYPE)
+    table['value'] = UNSOLVED
+
+    for first_player in PLAYERS:
+        _solve(Board(), first_player, table)
+
+    return table
+
+def save_table(table, path=SOLVED_TABLE_PATH):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    np.save(path, table)
+
+def load_table(path=SOLVED_TABLE_PATH):
+    """
+    Memory maps the solved table, solving and saving it first if it does not exist
+    """
+    if not os.path.exists(path):
+        save_table(solve_all(), path)
+    return np.load(path, mmap_mode='r')
+
+def empty_table():
+    table = np.zeros((len(PLAYERS), NUM_POSITIONS), dtype=TABLE_DTYPE)
+    table['value'] = UNSOLVED
+    return table
+
+def open_search_table(path=SEARCH_TABLE_PATH):
+    """
+    Memory maps a writable table for positions searched outside the solved table.
+    Every process opening the same path shares its pages, so a position searched by one
+    environment worker is a lookup for the others.
+    """
+    if not os.path.exists(path):
+        # Written under a temporary name so other processes never map a partial file
+        temporary_path = f"{path}.{os.getpid()}.tmp.npy"
+        save_table(empty_table(), temporary_path)
+
+        # Linking fails if another process created the table first, unlike a replace, which
+        # would leave processes that already mapped the first table on an unlinked copy
+        try:
+            os.link(temporary_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temporary_path)
+    return np.load(path, mmap_mode='r+')
+
+if __name__ == '__main__':
+    table = solve_all()
+    save_table(table)
+    print(f"Solved {int((table['value'] != UNSOLVED).sum())} positions, saved to {SOLVED_TABLE_PATH}")
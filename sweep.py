@@ -0,0 +1,248 @@
+"""
+Hyperparameter sweeps over the steering bound, the number of steered features and the rewards.
+
+A sweep is described by a JSON spec:
+    {
+        "name": "bound_and_draw",
+        "method": "grid",
+        "params": {"steering_bound": [0.1, 0.2], "num_actions": [10, 20], "reward_draw": [5, 10]},
+        "num_steps": 2000,
+        "eval_games": 20
+    }
+With "method": "random", "num_trials" trials are drawn with "seed", each parameter either from
+its list or uniformly from {"low": .., "high": ..}. A range with integer bounds draws integers,
+both inclusive, which num_actions and seed require.
+
+Trials run in a process pool and every trial has its own directory in output/sweeps/<name>/
+holding its checkpoints, tensorboard runs and result.json. All trials share one semaphore, so
+no more than max_concurrency API requests are in flight across the whole sweep. Finished
+trials are skipped and interrupted ones continue from their last checkpoint, so a crashed
+sweep is resumed by running it again. The results of every trial are collected in results.csv.
+
+    python sweep.py spec.json --workers 4 --max-concurrency 8
+"""
+import os, csv, glob, json, time, random, hashlib, argparse, itertools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from constants import TEACHER, STUDENT, STEERING_BOUND, NUM_ACTIONS_SAE
+
+SWEEP_DIRECTORY = 'output/sweeps'
+
+# Parameters a spec can sweep, the reward ones are attributes of TicTacToeEnv
+REWARD_FIELDS = ('reward_magnitude', 'reward_draw', 'reward_optimal_move', 'reward_suboptimal_move')
+PARAMS = ('steering_bound', 'num_actions', 'seed') + REWARD_FIELDS
+INTEGER_PARAMS = ('num_actions', 'seed')
+
+def make_trials(spec):
+    """
+    Returns the parameter dict of every trial described by the spec
+    """
+    params = spec['params']
+    unknown = set(params) - set(PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters {sorted(unknown)}, expected some of {list(PARAMS)}")
+
+    method = spec.get('method', 'grid')
+    if method == 'grid':
+        names = list(params)
+        return [dict(zip(names, values)) for values in itertools.product(*(params[name] for name in names))]
+
+    if method == 'random':
+        rng = random.Random(spec.get('seed', 0))
+
+        for name, values in params.items():
+            if name in INTEGER_PARAMS and isinstance(values, dict) and not all(isinstance(values[bound], int) for bound in ('low', 'high')):
+                raise ValueError(f"The range of {name} needs integer bounds, got {values}")
+
+        def draw(values):
+            if isinstance(values, dict):
+                if isinstance(values['low'], int) and isinstance(values['high'], int):
+                    return rng.randint(values['low'], values['high'])
+                return rng.uniform(values['low'], values['high'])
+            return rng.choice(values)
+
+        return [{name: draw(values) for name, values in params.items()} for _ in range(spec['num_trials'])]
+
+    raise ValueError(f"Unknown sweep method {method}, expected grid or random")
+
+def trial_id(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+
+def write_json(path, data):
+    # Written under a temporary name so a crash never leaves a partial file
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(temporary_path, path)
+
+# Shared by every trial of the pool, set by init_worker
+request_semaphore = None
+
+def init_worker(semaphore):
+    global request_semaphore
+    request_semaphore = semaphore
+
+    # Trials already run in parallel, more torch threads per trial only contend for the cores
+    import torch
+    torch.set_num_threads(1)
+
+def play_games(model, env, num_games):
+    """
+    Plays num_games with the deterministic policy and returns the student's wins, draws and losses
+    """
+    before = dict(env.results)
+    for _ in range(num_games):
+        state, _ = env.reset()
+        done = False
+        while not done:
+            action, _ = model.predict(state, deterministic=True)
+            state, _, done, _, _ = env.step(action)
+
+    return {
+        'wins': env.results[STUDENT] - before[STUDENT],
+        'draws': env.results['Draw'] - before['Draw'],
+        'losses': env.results[TEACHER] - before[TEACHER],
+    }
+
+def run_trial(params, directory, num_steps, eval_games, checkpoint_freq=100, local=False):
+    """
+    Trains and evaluates one trial in directory, continuing from its last checkpoint if there is one
+    """
+    # Imported here so the parent process does not load torch or the API client
+    from agents import OptimalAgent, RLAgent
+    from backends import LocalBackend, BudgetedBackend
+    from callbacks import AsyncCheckpointCallback
+    from move_checker import MoveChecker
+    from tictactoe import TicTacToeSAE
+    from utils import default_backend
+
+    os.makedirs(directory, exist_ok=True)
+    write_json(os.path.join(directory, 'params.json'), params)
+
+    seed = params.get('seed')
+    num_actions = params.get('num_actions', NUM_ACTIONS_SAE)
+
+    if local:
+        # Invalid answers make get_valid_move sleep, which would dominate the trial
+        backend = LocalBackend(seed=seed or 0, occupied_penalty=50.0)
+        action_features = backend.features[:num_actions]
+    else:
+        backend = default_backend
+        action_features = None
+
+    if request_semaphore is not None:
+        backend = BudgetedBackend(backend, request_semaphore)
+
+    move_checker = MoveChecker()
+    env = TicTacToeSAE(
+        move_checker,
+        OptimalAgent(TEACHER, move_checker),
+        backend=backend,
+        action_features=action_features,
+        steering_bound=params.get('steering_bound', STEERING_BOUND),
+        num_actions=num_actions,
+    )
+    for field in REWARD_FIELDS:
+        if field in params:
+            setattr(env, field, params[field])
+
+    tensorboard_log = os.path.join(directory, 'tensorboard')
+    checkpoint_dir = os.path.join(directory, 'checkpoints')
+
+    # An interrupted trial continues from its checkpoint
+    resumed = os.path.exists(os.path.join(checkpoint_dir, 'checkpoint.json'))
+    agent = RLAgent(STUDENT, use_checkpoint=resumed, tensorboard_log=tensorboard_log, seed=seed, checkpoint_dir=checkpoint_dir)
+    agent.setup_model(env)
+
+    start_timesteps = agent.model.num_timesteps
+    checkpoint_callback = AsyncCheckpointCallback(save_freq=checkpoint_freq, save_path=checkpoint_dir)
+
+    start = time.perf_counter()
+    if num_steps > start_timesteps:
+        agent.model.learn(total_timesteps=num_steps - start_timesteps, callback=checkpoint_callback, reset_num_timesteps=not resumed)
+    elapsed = time.perf_counter() - start
+    agent.model.save(os.path.join(directory, 'model'))
+
+    timesteps = agent.model.num_timesteps - start_timesteps
+    result = {
+        'trial': os.path.basename(directory),
+        **params,
+        **play_games(agent.model, env, eval_games),
+        'eval_games': eval_games,
+        'timesteps': agent.model.num_timesteps,
+        'train_seconds': elapsed,
+        'steps_per_sec': timesteps / elapsed if elapsed > 0 else None,
+        'resumed': resumed,
+    }
+    write_json(os.path.join(directory, 'result.json'), result)
+    env.close()
+    return result
+
+def write_results_table(sweep_directory):
+    """
+    Collects result.json of every finished trial into results.csv and returns the rows
+    """
+    rows = []
+    for path in sorted(glob.glob(os.path.join(sweep_directory, '*', 'result.json'))):
+        with open(path) as f:
+            rows.append(json.load(f))
+
+    columns = []
+    for row in rows:
+        columns += [column for column in row if column not in columns]
+
+    with open(os.path.join(sweep_directory, 'results.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+def run_sweep(spec, workers=4, max_concurrency=8, local=False, root=SWEEP_DIRECTORY):
+    """
+    Runs every trial of the spec that has not finished yet and returns the rows of the results table
+    """
+    sweep_directory = os.path.join(root, spec['name'])
+    os.makedirs(sweep_directory, exist_ok=True)
+    write_json(os.path.join(sweep_directory, 'spec.json'), spec)
+
+    trials = {}
+    for params in make_trials(spec):
+        directory = os.path.join(sweep_directory, trial_id(params))
+        if not os.path.exists(os.path.join(directory, 'result.json')):
+            trials[directory] = params
+    print(f"{len(trials)} trials left in {sweep_directory}")
+
+    # Spawned workers so that torch and the API client are not forked mid use
+    context = mp.get_context('spawn')
+    semaphore = context.BoundedSemaphore(max_concurrency)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(semaphore,)) as pool:
+        futures = {
+            pool.submit(run_trial, params, directory, spec['num_steps'], spec.get('eval_games', 20), spec.get('checkpoint_freq', 100), local): directory
+            for directory, params in trials.items()
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+                print(f"Trial {result['trial']}: {result['wins']} wins, {result['draws']} draws, {result['losses']} losses")
+            except Exception as e:
+                # The trial is retried from its last checkpoint on the next run
+                print(f"Trial {os.path.basename(futures[future])} failed", e)
+            write_results_table(sweep_directory)
+
+    return write_results_table(sweep_directory)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a hyperparameter sweep of TicTacToeSAE training")
+    parser.add_argument('spec', help="JSON file describing the sweep")
+    parser.add_argument('--workers', type=int, default=4, help="Trials run at the same time")
+    parser.add_argument('--max-concurrency', type=int, default=8, help="API requests in flight across all trials")
+    parser.add_argument('--local', action='store_true', help="Use LocalBackend instead of the API")
+    parser.add_argument('--root', default=SWEEP_DIRECTORY)
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+
+    rows = run_sweep(spec, args.workers, args.max_concurrency, args.local, args.root)
+    print(f"{len(rows)} finished trials in {os.path.join(args.root, spec['name'], 'results.csv')}")
@@ -0,0 +1,73 @@
+"""
+The 8 symmetries of the tic-tac-toe board, 4 rotations and their reflections.
+
+Under symmetry s, cell i of the transformed board is cell PERMUTATIONS[s][i] of the original.
+The canonical board of a position is the transformed board with the smallest key. Moves are
+carried along with to_canonical_move and from_canonical_move, so anything solved or cached
+for the canonical board can be reused for all 8 equivalent boards.
+"""
+import numpy as np
+
+from board import Board, KEY_CELLS, POW3, NUM_KEYS
+
+def _permutations():
+    grid = np.arange(9).reshape(3, 3)
+    permutations = []
+    for flipped in (grid, grid.T):
+        for turns in range(4):
+            permutations.append(np.rot90(flipped, turns).reshape(9))
+    return np.array(permutations, dtype=np.int64)
+
+# Index 0 is the identity
+PERMUTATIONS = _permutations()
+NUM_SYMMETRIES = len(PERMUTATIONS)
+
+# MOVE_MAPS[s][m] is where cell m of a board ends up after symmetry s
+MOVE_MAPS = np.argsort(PERMUTATIONS, axis=1)
+
+# Symmetry mapping a transformed board back to the original
+INVERSE = np.array([
+    next(t for t in range(NUM_SYMMETRIES) if (PERMUTATIONS[s][PERMUTATIONS[t]] == np.arange(9)).all())
+    for s in range(NUM_SYMMETRIES)
+], dtype=np.int64)
+
+# Key of every board after every symmetry, shape (8, 3**9)
+KEY_TRANSFORMS = np.stack([KEY_CELLS[:, permutation] @ POW3 for permutation in PERMUTATIONS])
+
+# Canonical key of every board and a symmetry taking the board there
+CANONICAL_SYMMETRY = KEY_TRANSFORMS.argmin(axis=0)
+CANONICAL_KEY = KEY_TRANSFORMS[CANONICAL_SYMMETRY, np.arange(NUM_KEYS)]
+
+# Bitboard masks after every symmetry, shape (8, 512)
+MASK_TRANSFORMS = np.array([
+    [sum(1 << int(MOVE_MAPS[s][i]) for i in range(9) if mask >> i & 1) for mask in range(1 << 9)]
+    for s in range(NUM_SYMMETRIES)
+], dtype=np.int64)
+
+def transform_board(board, symmetry):
+    return Board(int(MASK_TRANSFORMS[symmetry, board.x]), int(MASK_TRANSFORMS[symmetry, board.o]))
+
+def canonicalize(board):
+    """
+    Returns the canonical board of board and the symmetry that maps board to it
+    """
+    symmetry = int(CANONICAL_SYMMETRY[board.key])
+    return transform_board(board, symmetry), symmetry
+
+def to_canonical_move(move, symmetry):
+    return int(MOVE_MAPS[symmetry][move])
+
+def from_canonical_move(move, symmetry):
+    return int(PERMUTATIONS[symmetry][move])
+
+def moves_mask_from_canonical(mask, symmetry):
+    """
+    Maps a bitmask of moves on the canonical board back to the original board
+    """
+    return int(MASK_TRANSFORMS[INVERSE[symmetry], mask])
+
+def symmetric_observations(observations):
+    """
+    Returns every symmetric copy of an (N, 9) observation array, shape (8, N, 9)
+    """
+    return np.asarray(observations)[..., PERMUTATIONS].transpose(1, 0, 2)
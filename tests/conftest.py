@@ -0,0 +1,6 @@
+import os, sys
+
+# The modules live at the top of the repository and load their tables from output/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from backends import LocalBackend, FeatureTable
+from move_checker import MoveChecker
+from agents import OptimalAgent, RLAgent
+from tictactoe import TicTacToeSAE
+from board import Board, KEY_CELLS
+from utils import convert_boards_to_observations
+
+@pytest.fixture(scope='module')
+def agent():
+    backend = LocalBackend(seed=0)
+    move_checker = MoveChecker()
+    env = TicTacToeSAE(move_checker, OptimalAgent('X', move_checker), backend=backend,
+                       action_features=FeatureTable.from_features(backend.features[:4]))
+    agent = RLAgent('O', tensorboard_log=None, seed=0)
+    agent.setup_model(env)
+    return agent
+
+def test_single_observation_is_rejected():
+    with pytest.raises(ValueError):
+        convert_boards_to_observations(np.zeros(9, dtype=int))
+
+def test_boards_keys_and_observations_agree(agent):
+    keys = np.array([0, 1, 2 * 3 ** 4 + 1])
+    boards = [Board.from_key(int(key)) for key in keys]
+
+    expected = agent.act_batch(KEY_CELLS[keys])
+    assert np.allclose(agent.act_batch(keys=keys), expected)
+    assert np.allclose(agent.act_batch(boards), expected)
+    assert np.allclose(agent.act_batch([board.to_list() for board in boards]), expected)
+
+def test_act_uses_the_observation_with_a_partial_table(agent):
+    observation = KEY_CELLS[2 * 3 ** 4 + 1]
+    expected = agent.act_batch(observation[None])[0]
+    agent.precompute_actions(keys=[0])
+    try:
+        assert np.allclose(agent.act(observation, deterministic=True), expected)
+    finally:
+        agent.action_table = None
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from backends import LocalBackend, FeatureTable
+from move_checker import MoveChecker
+from agents import OptimalAgent
+from tictactoe import TicTacToeSAE
+from vec_env import AsyncSAEVecEnv
+from constants import ERROR_PUNISHMENT
+
+class FailingBackend(LocalBackend):
+    """
+    Local backend whose logits requests fail like a dropped connection
+    """
+
+    def move_logits(self, model, messages):
+        raise ConnectionError("connection reset")
+
+    async def move_logits_async(self, model, messages):
+        raise ConnectionError("connection reset")
+
+def make_env(move_selection='sample'):
+    backend = FailingBackend()
+    move_checker = MoveChecker()
+    return TicTacToeSAE(move_checker, OptimalAgent('X', move_checker), backend=backend,
+                        action_features=FeatureTable.from_features(backend.features[:4]), move_selection=move_selection)
+
+@pytest.mark.parametrize('move_selection', ['sample', 'argmax'])
+def test_failed_logits_request_plays_punished_fallback(move_selection):
+    env = make_env(move_selection)
+    env.reset(seed=0)
+    _, reward, _, _, info = env.step(np.zeros(4))
+
+    assert reward == ERROR_PUNISHMENT
+    assert info['fail_safe'] == 1
+
+def test_failed_logits_request_does_not_fail_the_batch():
+    env = AsyncSAEVecEnv([make_env, make_env])
+    try:
+        env.reset()
+        _, rewards, _, _ = env.step(np.zeros((2, 4)))
+    finally:
+        env.close()
+
+    assert (rewards == ERROR_PUNISHMENT).all()
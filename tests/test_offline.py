@@ -0,0 +1,40 @@
+import numpy as np
+
+from backends import LocalBackend, FeatureTable
+from move_checker import MoveChecker
+from agents import OptimalAgent, RLAgent
+from tictactoe import TicTacToeSAE
+from recorder import StepRecorder
+from offline import replay_buffer_transitions, step_log_transitions, merge_transitions
+
+def make_env(recorder=None):
+    backend = LocalBackend(seed=0)
+    move_checker = MoveChecker()
+    features = FeatureTable.from_features(backend.features[:4])
+    return TicTacToeSAE(move_checker, OptimalAgent('X', move_checker), backend=backend, action_features=features, recorder=recorder)
+
+def test_step_log_and_replay_buffer_copies_are_merged(tmp_path):
+    env = make_env()
+    env.recorder = StepRecorder(str(tmp_path / 'log'), env.action_features)
+    agent = RLAgent('O', tensorboard_log=None, seed=0)
+    agent.setup_model(env)
+    agent.model.learn(total_timesteps=60)
+    env.recorder.close()
+    agent.model.save_replay_buffer(str(tmp_path / 'buffer.pkl'))
+
+    from_buffer = replay_buffer_transitions(str(tmp_path / 'buffer.pkl'))
+    from_log = step_log_transitions(str(tmp_path / 'log'))
+    merged = merge_transitions([from_buffer, from_log])
+
+    assert len(from_log['rewards']) > 0
+    assert len(merged['rewards']) == len(merge_transitions([from_buffer])['rewards'])
+
+def test_step_log_drops_unfinished_last_game(tmp_path):
+    env = make_env(StepRecorder(str(tmp_path / 'log'), make_env().action_features))
+    env.reset(seed=0)
+    _, _, done, _, _ = env.step(np.zeros(4))
+    assert not done
+    env.close()
+
+    transitions = step_log_transitions(str(tmp_path / 'log'))
+    assert len(transitions['rewards']) == 0
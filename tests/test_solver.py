@@ -0,0 +1,20 @@
+import os
+import numpy as np
+
+import solver
+from solver import open_search_table, UNSOLVED
+
+def test_search_table_created_once(tmp_path, monkeypatch):
+    path = str(tmp_path / 'search_table.npy')
+    first = open_search_table(path)
+
+    # A second process that also found no table writes its own and must still map the first
+    exists = os.path.exists
+    monkeypatch.setattr(solver.os.path, 'exists', lambda p: False if p == path else exists(p))
+    second = open_search_table(path)
+
+    first['value'][0, 5] = 1
+    first.flush()
+    assert second['value'][0, 5] == 1
+    assert (second['value'][1] == UNSOLVED).all()
+    assert os.listdir(tmp_path) == ['search_table.npy']
@@ -0,0 +1,48 @@
+import json
+import httpx
+import numpy as np
+
+import utils
+from backends import GoodfireBackend, LocalBackend, FeatureTable
+from move_checker import MoveChecker
+from agents import OptimalAgent
+from main import make_sae_envs
+
+def stub_goodfire(monkeypatch, requests):
+    """
+    Answers every goodfire chat request with the first free cell of the board in the prompt
+    """
+    parser = LocalBackend()
+
+    def handler(request):
+        messages = json.loads(request.content)['messages']
+        requests.append(messages)
+        move = parser.parse_board(messages).index(False) + 1
+        return httpx.Response(200, json={
+            'id': 'stub', 'object': 'chat.completion', 'created': 0, 'model': 'stub', 'system_fingerprint': '',
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': str(move)}, 'finish_reason': 'stop'}],
+        })
+
+    async_client = httpx.AsyncClient
+    monkeypatch.setattr(httpx, 'AsyncClient', lambda *args, **kwargs: async_client(*args, transport=httpx.MockTransport(handler), **kwargs))
+
+def test_threaded_envs_use_goodfire_client(monkeypatch):
+    monkeypatch.setattr(utils, 'SLEEP_TIME', 0)
+    requests = []
+    stub_goodfire(monkeypatch, requests)
+
+    move_checker = MoveChecker()
+    action_features = FeatureTable.from_features(LocalBackend().features[:4])
+    env = make_sae_envs(move_checker, OptimalAgent('X', move_checker), num_envs=2, action_features=action_features,
+                        backend=GoodfireBackend(api_key='test'), rate_per_minute=1e9)
+    try:
+        env.reset()
+        for _ in range(3):
+            env.step(np.zeros((2, len(action_features))))
+        stats = [inner.unwrapped.stats for inner in env.envs]
+    finally:
+        env.close()
+
+    # Without an event loop on the env threads every request fails and ends in a fallback move
+    assert len(requests) == 6
+    assert all('fail_safe' not in env_stats for env_stats in stats)
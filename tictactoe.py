@@ -1,13 +1,25 @@
-from agents import display_board
+from board import Board
+from tracing import tracer
+from metrics import metrics
+from recorder import FLAG_FALLBACK, FLAG_MINOR_PUNISH
 import gymnasium as gym
 from constants import STUDENT, NUM_ACTIONS_SAE, STEERING_BOUND, ERROR_PUNISHMENT, MODEL
-from utils import get_base_api_format, get_valid_move, convert_board_to_observation, add_statistic, append_statistic
-from copy import deepcopy
-import goodfire
-import dotenv
-import pickle
+from prompting import prompt_builder
+from utils import display_board, get_valid_move, choose_move, convert_board_to_observation, add_statistic, append_statistic, default_backend
+from backends import FeatureTable
+import pickle, random
+import numpy as np
 
-dotenv.load_dotenv()
+RESULTS_PATH = 'output/results.pkl'
+
+def load_action_features(num_actions=NUM_ACTIONS_SAE, path=RESULTS_PATH):
+    """
+    Returns the num_actions most common feature candidates as a FeatureTable.
+    Load it once and pass it to every TicTacToeSAE instead of unpickling the Counter per env.
+    """
+    with open(path, 'rb') as f:
+        action_candidates = pickle.load(f)
+    return FeatureTable.from_features([x[0] for x in action_candidates.most_common(num_actions)])
 
 class TicTacToeEnv(gym.Env):
     
@@ -24,6 +36,9 @@ class TicTacToeEnv(gym.Env):
         self.action_space = gym.spaces.Discrete(9)
         self.observation_space = gym.spaces.Box(low=0, high=2, shape=(9,), dtype=int)
         
+        # Used for random moves of this environment, e.g. fallback moves
+        self.random = random.Random()
+        
         # Some statistics, does not get reset
         self.results = {
             'X': 0,
@@ -34,10 +49,17 @@ class TicTacToeEnv(gym.Env):
         self.reset()
         
     def reset(self, seed=None):
-        self.board = [x for x in range(1, 10)]
+        if seed is not None:
+            self.seed(seed)
+        self.board = Board()
         self._step(self.teacher.act(self.board), self.teacher.player)
         return self._obs(), {} # Return observation and empty info
     
+    def seed(self, seed):
+        self.random.seed(seed)
+        if hasattr(self.teacher, 'random'):
+            self.teacher.random.seed(seed)
+    
     def render(self):
         display_board(self.board, print_board=True)
         
@@ -53,27 +75,13 @@ class TicTacToeEnv(gym.Env):
     def check_winner(self):
         """
         Checks if the state of the board is a winning state
-        Returns the winner if there is one, None otherwise
+        Returns the winner if there is one, 'Draw' if the board is full, None otherwise
         """
-        # Check rows
-        for i in range(3):
-            if self.board[i*3] == self.board[i*3 + 1] == self.board[i*3 + 2]:
-                return self.board[i*3]
-        
-        # Check columns
-        for i in range(3):
-            if self.board[i] == self.board[i + 3] == self.board[i + 6]:
-                return self.board[i]
-        
-        # Check diagonals
-        if self.board[0] == self.board[4] == self.board[8]:
-            return self.board[0]
-        
-        if self.board[2] == self.board[4] == self.board[6]:
-            return self.board[2]
+        winner = self.board.winner()
+        if winner:
+            return winner
         
-        # Check for draw
-        if all([x in ['X', 'O'] for x in self.board]):
+        if self.board.is_full():
             return 'Draw'
         
         return None
@@ -90,22 +98,23 @@ class TicTacToeEnv(gym.Env):
         # Validate action
         if not 0 <= action <= 8:
             raise ValueError("Invalid action. Must be between 0 and 8")
-        if self.board[action] not in range(1, 10):
+        if not self.board.is_empty(action):
             raise ValueError("Invalid action. Position already taken")
         if current_player not in ['X', 'O']:
             raise ValueError("Invalid player. Must be X or O")
         
-        # Make copy of board
-        old_board = self.board.copy()
+        # Only the student's moves are rewarded, so the teacher's moves skip the lookup
+        is_optimal = current_player == 'O' and self.move_checker.is_optimal_move(self.board, action, current_player)
 
         # Place mark on board
-        self.board[action] = current_player
+        self.board.place(action, current_player)
         
         # Check for winner
         winner = self.check_winner()
         
         if winner:
             self.results[winner] += 1
+            metrics.emit('game', result=winner)
             done = True
         else:
             done = False
@@ -117,10 +126,9 @@ class TicTacToeEnv(gym.Env):
         elif winner == 'O':
             reward = self.reward_magnitude
         elif winner == 'Draw':
-            print("Draw")
             reward = self.reward_draw
         else:
-            if action in self.move_checker.get_optimal_moves(old_board, current_player):
+            if is_optimal:
                 # Give the player who made the optimal move a small reward
                 reward = self.reward_optimal_move if current_player == 'O' else 0
             else:
@@ -129,89 +137,247 @@ class TicTacToeEnv(gym.Env):
         
         # Immediately compute the teacher's move if the game is not done
         if not done and current_player != 'X':
-            _, _, done, _, _ = self._step(self.teacher.act(self.board), self.teacher.player)
+            with tracer.span('teacher_move'):
+                teacher_action = self.teacher.act(self.board)
+            _, _, done, _, _ = self._step(teacher_action, self.teacher.player)
         
         # The player will always be O
         # Truncation is always False, and empty dict is returned for now
         return self._obs(), reward, done, False, {}
     
     def step(self, action):
-        obs, reward, terminated, truncated, info = self._step(action, STUDENT) # Player is always O
+        with tracer.span('_step'):
+            obs, reward, terminated, truncated, info = self._step(action, STUDENT) # Player is always O
         return obs, reward, terminated, truncated, info
     
 class TicTacToeSAE(TicTacToeEnv):
     
-    def __init__(self, move_checker, teacher, test_mode=False, verbose=False):
+    def __init__(self, move_checker, teacher, test_mode=False, verbose=False, cache=None, backend=None, action_features=None, trace=False, recorder=None, steering_bound=STEERING_BOUND, num_actions=NUM_ACTIONS_SAE, move_selection='completion', edit_dead_band=0.0, top_k=None):
         super().__init__(move_checker, teacher)
         
-        # Loads a Counter from Collections
-        action_candidates = pickle.load(open('output/results.pkl', 'rb'))
+        if action_features is None:
+            action_features = load_action_features(num_actions)
         
-        # Get the top NUM_ACTIONS_SAE actions
-        self.action_features = [x[0] for x in action_candidates.most_common(NUM_ACTIONS_SAE)]
-        true_action_length = len(self.action_features)
+        # A FeatureTable is turned into features on first use, see action_features
+        self._action_features = action_features if isinstance(action_features, FeatureTable) else list(action_features)
+        true_action_length = len(self._action_features)
         
-        # Each action corresponds to a continuous space bounded by STEERING_BOUND for each element in action_features
-        self.action_space = gym.spaces.Box(low=-STEERING_BOUND, high=STEERING_BOUND, shape=(true_action_length,), dtype=float)
-        print("Bound:", STEERING_BOUND)
+        # Each action corresponds to a continuous space bounded by steering_bound for each element in action_features
+        self.steering_bound = steering_bound
+        self.action_space = gym.spaces.Box(low=-steering_bound, high=steering_bound, shape=(true_action_length,), dtype=float)
+        print("Bound:", steering_bound)
         self.observation_space = gym.spaces.Box(low=0, high=2, shape=(9,), dtype=int)
         
         # Used when the agent makes an invalid move, set by get_valid_move
         self.will_punish = False
         self.minor_punish = False
         
-        self.model = goodfire.Variant(MODEL)
-        self.api_template = get_base_api_format()
+        self.backend = backend if backend is not None else default_backend
+        self._model = None
+        self.prompts = prompt_builder()
+        
+        # 'completion' parses a free form answer, 'sample' and 'argmax' pick from the logits of
+        # the nine moves in one request, the last distribution is kept in move_distribution
+        self.move_selection = move_selection
+        self.move_distribution = None
+        
+        # Steering values within edit_dead_band of zero are dropped and changes smaller than it
+        # are not sent, with top_k only the k strongest values are applied, see sparsify_action
+        self.edit_dead_band = edit_dead_band
+        self.top_k = top_k
+        
+        # Edits currently set on the variant, by feature position
+        self.applied_edits = {}
         
         self.stats = {'activations': {}}
         self.test_mode = test_mode
         self.verbose = verbose
         
+        # Timings are sent through the step info, see callbacks.TracingCallback
+        if trace:
+            tracer.enabled = True
+        
+        # Move chosen outside of step, see AsyncSAEVecEnv
+        self.pending_move = None
+        
+        # Optional CompletionCache, the key and symmetry are set by prepare_completion
+        self.cache = cache
+        self.cache_key = None
+        self.cache_symmetry = 0
+        
+        # Optional StepRecorder, replaces stats['activations'] in test mode
+        self.recorder = recorder
+        self.last_action = None
+        
+    @property
+    def action_features(self):
+        if isinstance(self._action_features, FeatureTable):
+            self._action_features = self._action_features.features()
+        return self._action_features
+    
+    @property
+    def model(self):
+        # The variant is created on the first step so that constructing the env stays cheap
+        if self._model is None:
+            self._model = self.backend.variant(MODEL)
+        return self._model
+    
     def reset(self, seed=None):
-        self.board = [x for x in range(1, 10)]
+        if seed is not None:
+            self.seed(seed)
+        self.board = Board()
         self._step(self.teacher.act(self.board), self.teacher.player)
         return convert_board_to_observation(self.board), {}
         
-    def step(self, action):
+    def prepare_completion(self, action):
+        """
+        Applies the steering action to the variant and returns the prompt for the current board
+        """
+        # Cached completions are only valid for the exact edits that were sent
+        if self.cache is not None:
+            action = self.cache.dequantize(self.cache.quantize(action))
         
-        self.model.reset()
+        with tracer.span('variant_edit'):
+            action = self.apply_edits(self.sparsify_action(action))
         
         # Zip the action features with the action values
-        action_values = zip(self.action_features, action)
+        action_values = list(zip(self.action_features, action))
+        self.last_action = action
         
-        if self.test_mode:
-            logged_action_values = list(action_values)
+        if self.test_mode and self.recorder is None:
             state_key = tuple(self.board)
-            append_statistic(self.stats['activations'], state_key, logged_action_values)
+            append_statistic(self.stats['activations'], state_key, action_values)
             
+        with tracer.span('prompt_render'):
+            api_format = self.prompts.api_format(self.board, STUDENT)
         
-        for feature, value in action_values:
+        # Keyed on the edits that are actually applied, so dropped noise does not split entries
+        if self.cache is not None:
+            self.cache_key = self.cache.make_key(self.model.base_model, api_format, self.board.key, self.cache.quantize(action), self.move_selection)
+            self.cache_symmetry = self.cache.symmetry(self.board.key)
+        
+        return api_format
+    
+    def sparsify_action(self, action):
+        """
+        Zeroes the values within the dead band and, with top_k, all but the k strongest values
+        """
+        action = np.array(action, dtype=float)
+        action[np.abs(action) <= self.edit_dead_band] = 0
+        
+        if self.top_k is not None and self.top_k < len(action):
+            action[np.argsort(-np.abs(action), kind='stable')[self.top_k:]] = 0
+        return action
+    
+    def apply_edits(self, action):
+        """
+        Updates the variant's edits to action, only touching the features whose value changed
+        by more than the dead band. Returns the steering applied afterwards.
+        """
+        for i, value in enumerate(action):
+            feature = self.action_features[i]
+            
+            if value == 0:
+                if i in self.applied_edits:
+                    self.model.clear(feature)
+                    del self.applied_edits[i]
+                    tracer.count('edits_cleared')
+                continue
+            
+            if i in self.applied_edits and abs(value - self.applied_edits[i]) <= self.edit_dead_band:
+                continue
+            
             self.model.set(feature, value)
+            self.applied_edits[i] = value
+            tracer.count('edits_set')
             
             if self.verbose:
-                print(f"Setting {feature} to {value}")
-            
-        # Create copy of the template
-        api_format = deepcopy(self.api_template)
+                metrics.emit('edit', feature=i, value=float(value))
         
-        api_format['user']['content'] = self.api_template['user']['content'].format(board=display_board(self.board), player_type=STUDENT)
+        applied = np.zeros(len(action))
+        for i, value in self.applied_edits.items():
+            applied[i] = value
+        return applied
+    
+    def cached_move(self):
+        """
+        Returns the cached move for the prepared completion, None on a miss or without a cache
+        """
+        if self.cache is None:
+            return None
+        
+        # The move is chosen again from the cached distribution, with its punishment
+        if self.move_selection != 'completion':
+            probabilities = self.cache.get_distribution(self.cache_key, self.cache_symmetry)
+            add_statistic(self.stats, 'cache_hit' if probabilities is not None else 'cache_miss')
+            return None if probabilities is None else choose_move(self, self.board, probabilities, is_sae_rl=True)[0]
+        
+        hit = self.cache.get(self.cache_key, self.cache_symmetry)
+        add_statistic(self.stats, 'cache_hit' if hit else 'cache_miss')
+        return None if hit is None else hit[1]
+    
+    def cache_move(self, move, completion_text):
+        # Fallback moves are not cached so that their punishment is not skipped
+        if self.cache is None or completion_text == "Error":
+            return
         
-        move, _ = get_valid_move(self, self.board, api_format, is_sae_rl=True)
+        if self.move_selection != 'completion':
+            self.cache.put_distribution(self.cache_key, self.move_distribution, self.cache_symmetry)
+        else:
+            self.cache.put(self.cache_key, completion_text, move, self.cache_symmetry)
+    
+    def apply_move(self, move):
+        """
+        Plays the student's move and applies any punishment set by get_valid_move
+        """
         add_statistic(self.stats, f"move_{move+1}")
+        board_key = self.board.key
+        flags = FLAG_FALLBACK * (self.will_punish or self.minor_punish) + FLAG_MINOR_PUNISH * self.minor_punish
         
-        obs, reward, terminated, truncated, info = self._step(move, STUDENT)
+        with tracer.span('_step'):
+            obs, reward, terminated, truncated, info = self._step(move, STUDENT)
         
         obs = convert_board_to_observation(obs)
         
         if self.will_punish:
             reward = ERROR_PUNISHMENT
             self.will_punish = False
+            metrics.emit('punishment', reward=reward, minor=False)
             
         if self.minor_punish:
             reward = ERROR_PUNISHMENT / 2
             self.minor_punish = False
+            metrics.emit('punishment', reward=reward, minor=True)
+        
+        if self.recorder is not None:
+            self.recorder.record(board_key, self.last_action, move, reward, flags)
+        
+        # A copy, Monitor adds the episode to the info and it must not stay in stats
+        info = {**self.stats}
+        if tracer.enabled:
+            info['trace'] = tracer.drain()
+        
+        return obs, reward, terminated, truncated, info
+    
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+        
+    def step(self, action):
+        
+        # Set by vectorized environments that fetch the completions for every env at once
+        if self.pending_move is not None:
+            move, self.pending_move = self.pending_move, None
+            return self.apply_move(move)
+        
+        api_format = self.prepare_completion(action)
+        move = self.cached_move()
+        
+        if move is None:
+            move, completion_text = get_valid_move(self, self.board, api_format, is_sae_rl=True)
+            self.cache_move(move, completion_text)
         
-        return obs, reward, terminated, truncated, self.stats
+        return self.apply_move(move)
          
 if __name__ == '__main__':
     env = TicTacToeEnv()
@@ -0,0 +1,93 @@
+"""
+Lightweight timing and counters for the environment hot path.
+
+Tracing is off by default, in which case span returns a shared no-op context manager and
+count returns immediately. Environments drain the collected data into their step info so
+that TracingCallback can export it from any worker process. The data is kept per thread, so
+environments stepped on threads, see vec_env.ThreadedVecEnv, only drain their own.
+"""
+import time, functools, threading
+from contextlib import nullcontext
+from collections import defaultdict
+
+NULL_SPAN = nullcontext()
+
+class Span:
+
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.timings[self.name].append(time.perf_counter() - self.start)
+        return False
+
+class Tracer:
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._local = threading.local()
+
+    @property
+    def timings(self):
+        local = self._local
+        if not hasattr(local, 'timings'):
+            local.timings = defaultdict(list)
+        return local.timings
+
+    @property
+    def counters(self):
+        local = self._local
+        if not hasattr(local, 'counters'):
+            local.counters = defaultdict(int)
+        return local.counters
+
+    def span(self, name):
+        """
+        Context manager that records how long its block took under name
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] += amount
+
+    def drain(self):
+        """
+        Returns everything the calling thread collected since its last drain and clears it
+        """
+        snapshot = {'timings': dict(self.timings), 'counters': dict(self.counters)}
+        self._local.timings = defaultdict(list)
+        self._local.counters = defaultdict(int)
+        return snapshot
+
+    def merge(self, snapshot):
+        for name, durations in snapshot['timings'].items():
+            self.timings[name].extend(durations)
+        for name, amount in snapshot['counters'].items():
+            self.counters[name] += amount
+
+# Shared by everything in this process, enabled by environments created with trace=True
+tracer = Tracer()
+
+def traced(name):
+    """
+    Decorator that records every call of the function under name while tracing is enabled
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            with Span(tracer, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,18 +1,19 @@
-import os, time, random, re
+import time, random, re
 import numpy as np
 from constants import RETRY_COUNT, SLEEP_TIME
-import goodfire
-import dotenv
+from board import as_board, KEY_CELLS, MASK_TO_CELLS
+from prompting import prompt_builder, render_board
+from backends import GoodfireBackend, is_rate_limit_error, MOVE_TOKENS
+from tracing import tracer, traced
+from metrics import metrics
 import tenacity
 
-dotenv.load_dotenv()
-
-client = goodfire.Client(
-    os.getenv('GOODFIRE_API_KEY'),
-)
+# Used by agents and environments that are not given a backend
+# The API key is read from GOODFIRE_API_KEY when the first request is made
+default_backend = GoodfireBackend()
 
 def get_top_features(agent, state, move, api_format):
-    context = client.features.inspect(
+    context = agent.backend.inspect(
         [
             api_format['system'],
             api_format['user'],
@@ -21,6 +22,15 @@ def get_top_features(agent, state, move, api_format):
         model=agent.model
     )
     
+    token = find_move_token(context, move)
+    if token is not None:
+        top_features = token.inspect()
+        append_statistic(agent.stats['top_features'], tuple(state), top_features)
+
+def find_move_token(context, move):
+    """
+    Returns the token of an inspected context that holds the move, None if there is none
+    """
     for token in context.tokens:
         token_text = token._token.strip()
         
@@ -28,21 +38,18 @@ def get_top_features(agent, state, move, api_format):
         if token_text.isdigit():
             
             if move == int(token_text) - 1:             
-                top_features = token.inspect()
-                append_statistic(agent.stats['top_features'], tuple(state), top_features)
-                break
+                return token
+    
+    return None
 
 def get_base_api_format():
     
-    with open('prompts/system_prompt.txt', 'r') as f:
-        system_prompt = f.read()
-        
-    with open('prompts/user_prompt.txt', 'r') as f:
-        user_prompt = f.read()
+    # Templates are read from disk once per process
+    builder = prompt_builder()
         
     api_format = {
-        'system' : {"role": "system", "content": system_prompt},
-        'user' : {"role": "user", "content": user_prompt}, # Needs to be filled in
+        'system' : dict(builder.system_message),
+        'user' : {"role": "user", "content": builder.user_template}, # Needs to be filled in
         'assistant' : {"role": "assistant", "content": None} # Placeholder for assistant response
     }
         
@@ -64,31 +71,94 @@ def append_statistic(stats, key, value):
         stats[key].append(value)
     return stats
 
-def get_completion(model, api_format):
+# Rate limited requests are retried with exponential backoff before giving up
+RATE_LIMIT_ATTEMPTS = 3
+
+def request_with_retry(request, *args, **kwargs):
     """Wrapper function to handle retry errors"""
     try:
-        return _get_completion_with_retry(model, api_format)
+        return _request_with_retry(request, *args, **kwargs)
     except tenacity.RetryError:
-        print("Gave up after 3 retries (60 seconds) due to rate limiting")
+        metrics.emit('gave_up', attempts=RATE_LIMIT_ATTEMPTS)
         raise
 
-@tenacity.retry(stop=tenacity.stop_after_attempt(3), wait=tenacity.wait_exponential(multiplier=2, min=15, max=60), retry=tenacity.retry_if_exception_type(goodfire.api.exceptions.RateLimitException))
-def _get_completion_with_retry(model, api_format):
+@tenacity.retry(stop=tenacity.stop_after_attempt(RATE_LIMIT_ATTEMPTS), wait=tenacity.wait_exponential(multiplier=2, min=15, max=60), retry=tenacity.retry_if_exception(is_rate_limit_error))
+def _request_with_retry(request, *args, **kwargs):
     try:
-        completion = client.chat.completions.create(
-            model=model,
-            messages=[
-            api_format['system'],
-            api_format['user']
-        ],
-            max_completion_tokens=25
-        )
+        return request(*args, **kwargs)
     except Exception as e:
-        if not isinstance(e, goodfire.api.exceptions.RateLimitException):
-            print("Error getting completion", e)
+        if not is_rate_limit_error(e):
+            metrics.emit('completion_error', error=repr(e))
+        else:
+            tracer.count('rate_limit_hits')
         raise
+
+@traced('get_completion')
+def get_completion(model, api_format, backend=default_backend):
+    return request_with_retry(
+        backend.complete,
+        model,
+        [
+        api_format['system'],
+        api_format['user']
+    ],
+        max_completion_tokens=25
+    )
+
+@traced('get_move_logits')
+def get_move_logits(model, api_format, backend=default_backend):
+    return request_with_retry(backend.move_logits, model, [api_format['system'], api_format['user']])
+
+def move_probabilities(logits):
+    """
+    Softmax over the nine move tokens, tokens missing from the logits get no probability
+    """
+    logits = np.array([logits.get(token, -np.inf) for token in MOVE_TOKENS], dtype=float)
+    if not np.isfinite(logits).any():
+        return np.zeros(9)
+    probabilities = np.exp(logits - logits[np.isfinite(logits)].max())
+    return probabilities / probabilities.sum()
+
+def choose_move(agent, state, probabilities, is_sae_rl=False):
+    """
+    Picks a free cell from the move distribution, sampled or the most likely one depending on
+    agent.move_selection. The distribution is kept in agent.move_distribution.
+    """
+    board = as_board(state)
+    agent.move_distribution = probabilities
+    
+    free = np.array([board.is_empty(move) for move in range(9)])
+    legal = np.where(free, probabilities, 0.0)
+    if legal.sum() == 0:
+        return fallback_move(agent, state, False, is_sae_rl)
+    
+    # The masked cell would have been an invalid answer, punished like one
+    if not free[int(np.argmax(probabilities))]:
+        add_statistic(agent.stats, 'invalid_move')
+        if is_sae_rl:
+            agent.minor_punish = True
     
-    return completion.choices[0].message['content']
+    if agent.move_selection == 'sample':
+        move = getattr(agent, 'random', random).choices(range(9), weights=legal)[0]
+    elif agent.move_selection == 'argmax':
+        move = int(np.argmax(legal))
+    else:
+        raise ValueError(f"Unknown move selection {agent.move_selection}, expected completion, sample or argmax")
+    
+    return move, MOVE_TOKENS[move]
+
+def get_distribution_move(agent, state, api_format, is_sae_rl=False):
+    """
+    Gets a move with a single request for the logits of the nine moves, occupied cells are masked locally
+    """
+    try:
+        logits = get_move_logits(agent.model, api_format, agent.backend)
+    except Exception as e:
+        # Failed requests end in a punished random move, like failed completions
+        add_statistic(agent.stats, 'invalid_move')
+        metrics.emit('invalid_answer', error=repr(e), occupied=False)
+        return fallback_move(agent, state, False, is_sae_rl)
+    return choose_move(agent, state, move_probabilities(logits), is_sae_rl)
 
 def extract_move(text, verbose=False):
     """
@@ -115,72 +185,112 @@ def display_board(board, print_board=False):
         """
         Minimal representation of the board
         """
-        
-        text = ''
-        for i in range(3):
-            text += ' '.join(map(str, board[i*3:i*3+3]))
-            
-            if i < 2:
-                text += '\n'
+        text = render_board(board)
             
         if print_board:
             print(text, end='\n')
             
         return text
 
+class OccupiedCellError(ValueError):
+    pass
+
+def check_move(state, completion_text):
+    """
+    Extracts the move from a completion and raises if it cannot be played on the board
+    """
+    move = extract_move(completion_text)
+    
+    # Check if move is already taken
+    if not as_board(state).is_empty(move):
+        raise OccupiedCellError("Move already taken")
+    return move
+
+def fallback_move(agent, state, minor_punish, is_sae_rl=False):
+    """
+    Plays a random move once all attempts at getting a valid move have failed
+    """
+    add_statistic(agent.stats, 'fail_safe')
+    tracer.count('fallback_random_moves')
+    metrics.emit('fallback', minor_punish=minor_punish)
+    completion_text = "Error"
+    
+    if is_sae_rl:
+        if minor_punish:
+            agent.minor_punish = True
+        else:
+            agent.will_punish = True
+    
+    return getattr(agent, 'random', random).choice(as_board(state).legal_moves()), completion_text
+
+@traced('get_valid_move')
 def get_valid_move(agent, state, api_format, verbose=False, is_sae_rl=False):
+    
+    # One request for the move distribution instead of parsing completions, see choose_move
+    if getattr(agent, 'move_selection', 'completion') != 'completion':
+        return get_distribution_move(agent, state, api_format, is_sae_rl)
+    
     for _ in range(RETRY_COUNT):
         
         minor_punish = False
         
         try:
-            completion_text = get_completion(agent.model, api_format)
-            move = extract_move(completion_text)
+            completion_text = get_completion(agent.model, api_format, agent.backend)
+            move = check_move(state, completion_text)
             
             if verbose:
                 print(state)
                 print(move)
             
-            # Check if move is already taken
-            if state[move] in ['X', 'O']:
-                minor_punish = True
-                raise ValueError("Move already taken")
             return move, completion_text
         
         except Exception as e: 
+            minor_punish = isinstance(e, OccupiedCellError)
             add_statistic(agent.stats, 'invalid_move')
-            if verbose:
-                print(f"Error: {e}")
+            tracer.count('retries')
+            metrics.emit('invalid_answer', error=repr(e), occupied=minor_punish)
             time.sleep(SLEEP_TIME)
         
-    add_statistic(agent.stats, 'fail_safe')
-    completion_text = "Error"
-    
-    if is_sae_rl:
-        if minor_punish:
-            agent.minor_punish = True
-        else:
-            agent.will_punish = True
-    
-    return random.choice([i for i, spot in enumerate(state) if spot not in ['X', 'O']]), completion_text
+    return fallback_move(agent, state, minor_punish, is_sae_rl)
 
 def convert_board_to_observation(board):
     """
     Converts the current board state into a format recognizable by Stable Baselines.
     
     Args:
-        board (list): The current board state as a list of length 9.
-                    Each element should be 'X', 'O', or None.
+        board (Board or list): The current board state, either a Board or a list of length 9.
+                    Each list element should be 'X', 'O', or the cell number.
     
     Returns:
         np.ndarray: A numpy array of shape (9,) with values 0, 1, or 2.
     """
-    observation = np.zeros(9, dtype=int)
-    for i, cell in enumerate(board):
-        if cell == 'X':
-            observation[i] = 1
-        elif cell == 'O':
-            observation[i] = 2
-        else:
-            observation[i] = 0
-    return observation
\ No newline at end of file
+    return as_board(board).to_observation()
+
+def convert_boards_to_observations(boards=None, keys=None):
+    """
+    Batched convert_board_to_observation.
+    
+    Args:
+        boards: Board objects, boards in list form, or an (N, 9) array of observations.
+        keys: Position keys, given instead of boards.
+    
+    Returns:
+        np.ndarray: An array of shape (N, 9) with values 0, 1, or 2.
+    """
+    if keys is not None:
+        return KEY_CELLS[np.asarray(keys, dtype=np.int64)]
+    
+    if isinstance(boards, np.ndarray):
+        # A single observation or an array of keys would otherwise be read as several boards
+        if boards.ndim != 2 or boards.shape[1] != 9:
+            raise ValueError(f"Expected an (N, 9) array of observations, got shape {boards.shape}, pass position keys as keys")
+        return boards
+    
+    boards = [as_board(board) for board in boards]
+    if not boards:
+        return np.zeros((0, 9), dtype=int)
+    
+    # The bitboards index the cell table directly, without a loop over the cells
+    x = np.fromiter((board.x for board in boards), dtype=np.int64, count=len(boards))
+    o = np.fromiter((board.o for board in boards), dtype=np.int64, count=len(boards))
+    return MASK_TO_CELLS[x] + 2 * MASK_TO_CELLS[o]
\ No newline at end of file
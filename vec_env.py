@@ -0,0 +1,245 @@
+import asyncio, multiprocessing
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import gymnasium as gym
+from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv
+from stable_baselines3.common.vec_env.base_vec_env import VecEnv
+
+from board import POW3, KEY_CELLS, KEY_OUTCOMES, MASK_POPCOUNT, MASK_MOVES_PADDED
+from solver import load_table, SOLVED_TABLE_PATH
+from completions import AsyncCompleter
+from tracing import tracer, Tracer
+
+# Values stored in KEY_OUTCOMES
+IN_PROGRESS, X_WINS, O_WINS, DRAW = 0, 1, 2, 3
+
+# Imported once by the fork server, so every worker forked from it starts with them loaded
+WORKER_PRELOAD = ['stable_baselines3.common.vec_env.subproc_vec_env', 'stable_baselines3.common.monitor', 'tictactoe', 'agents']
+
+def make_subproc_vec_env(env_fns, preload=WORKER_PRELOAD):
+    """
+    SubprocVecEnv whose workers are forked from a fork server that has already imported preload,
+    instead of each worker importing torch and the environments on its own
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return SubprocVecEnv(env_fns)
+
+    # Only takes effect if the fork server has not been started yet
+    multiprocessing.set_forkserver_preload(preload)
+    return SubprocVecEnv(env_fns, start_method='forkserver')
+
+class TicTacToeVecEnv(VecEnv):
+    """
+    Batched version of TicTacToeEnv where the teacher is always an OptimalAgent playing X.
+    All boards are held as base 3 position keys in one array, so moves, win checks, rewards
+    and the teacher's replies are array lookups across the batch.
+    """
+
+    def __init__(self, num_envs, move_checker=None, seed=None):
+        # Reuse the move checker's table when one is given to avoid loading it twice
+        table = move_checker.table if move_checker is not None else load_table(SOLVED_TABLE_PATH)
+        self.optimal_masks = np.asarray(table['moves'], dtype=np.int64)
+
+        # Same reward structure as TicTacToeEnv
+        self.reward_magnitude = 2
+        self.reward_draw = 10
+        self.reward_optimal_move = 10
+        self.reward_suboptimal_move = -2
+
+        self.render_mode = None
+        super().__init__(
+            num_envs,
+            observation_space=gym.spaces.Box(low=0, high=2, shape=(9,), dtype=int),
+            action_space=gym.spaces.Discrete(9),
+        )
+
+        self.rng = np.random.default_rng(seed)
+        self.keys = np.zeros(num_envs, dtype=np.int64)
+        self.actions = None
+
+        # Some statistics, does not get reset
+        self.results = {
+            'X': 0,
+            'O': 0,
+            'Draw': 0
+        }
+
+    def _teacher_move(self, indices):
+        """
+        Plays a uniformly random optimal move for X on the given boards
+        """
+        masks = self.optimal_masks[0, self.keys[indices]]
+        choice = (self.rng.random(len(indices)) * MASK_POPCOUNT[masks]).astype(np.int64)
+        moves = MASK_MOVES_PADDED[masks, choice]
+        self.keys[indices] += POW3[moves]
+
+    def _reset_boards(self, indices):
+        self.keys[indices] = 0
+        self._teacher_move(indices)
+
+    def _record_results(self, outcomes):
+        counts = np.bincount(outcomes, minlength=4)
+        self.results['X'] += int(counts[X_WINS])
+        self.results['O'] += int(counts[O_WINS])
+        self.results['Draw'] += int(counts[DRAW])
+
+    def reset(self):
+        self._reset_boards(np.arange(self.num_envs))
+        return KEY_CELLS[self.keys]
+
+    def step_async(self, actions):
+        self.actions = actions
+
+    def step_wait(self):
+        actions = np.asarray(self.actions, dtype=np.int64).reshape(self.num_envs)
+
+        if ((actions < 0) | (actions > 8)).any():
+            raise ValueError("Invalid action. Must be between 0 and 8")
+        if (KEY_CELLS[self.keys, actions] != 0).any():
+            raise ValueError("Invalid action. Position already taken")
+
+        # Optimality is judged on the board before the student's move
+        is_optimal = (self.optimal_masks[1, self.keys] >> actions) & 1
+        self.keys += 2 * POW3[actions]
+
+        outcomes = KEY_OUTCOMES[self.keys].astype(np.int64)
+        rewards = np.where(is_optimal == 1, self.reward_optimal_move, self.reward_suboptimal_move).astype(np.float32)
+        rewards[outcomes == O_WINS] = self.reward_magnitude
+        rewards[outcomes == DRAW] = self.reward_draw
+
+        # Teacher replies on every board that is still in progress
+        in_progress = np.flatnonzero(outcomes == IN_PROGRESS)
+        self._teacher_move(in_progress)
+        outcomes[in_progress] = KEY_OUTCOMES[self.keys[in_progress]]
+
+        dones = outcomes != IN_PROGRESS
+        finished = np.flatnonzero(dones)
+        self._record_results(outcomes[finished])
+
+        infos = [{} for _ in range(self.num_envs)]
+        terminal_observations = KEY_CELLS[self.keys[finished]]
+        for i, terminal_observation in zip(finished, terminal_observations):
+            infos[i]['terminal_observation'] = terminal_observation
+
+        # Auto reset like the other SB3 vectorized environments
+        self._reset_boards(finished)
+
+        return KEY_CELLS[self.keys], rewards, dones, infos
+
+    def seed(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        return [seed for _ in range(self.num_envs)]
+
+    def close(self):
+        pass
+
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(self, attr_name) for _ in self._get_indices(indices)]
+
+    def set_attr(self, attr_name, value, indices=None):
+        setattr(self, attr_name, value)
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return [getattr(self, method_name)(*method_args, **method_kwargs) for _ in self._get_indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [False for _ in self._get_indices(indices)]
+
+class AsyncSAEVecEnv(DummyVecEnv):
+    """
+    Runs several TicTacToeSAE environments in one process and fetches the completions for
+    all of them concurrently, so each step costs about one API round trip for the whole batch.
+    The environments may be wrapped, e.g. in a Monitor.
+    """
+
+    def __init__(self, env_fns, completer=None):
+        super().__init__(env_fns)
+        self.completer = completer if completer is not None else AsyncCompleter(self.envs[0].unwrapped.backend)
+
+    def step_wait(self):
+        sae_envs = [env.unwrapped for env in self.envs]
+        api_formats = [env.prepare_completion(action) for env, action in zip(sae_envs, self.actions)]
+
+        # Only cache misses go to the API
+        for env in sae_envs:
+            env.pending_move = env.cached_move()
+        missing = [i for i, env in enumerate(sae_envs) if env.pending_move is None]
+
+        moves = self.completer.get_valid_moves(
+            [sae_envs[i] for i in missing],
+            [sae_envs[i].board for i in missing],
+            [api_formats[i] for i in missing],
+            is_sae_rl=True
+        )
+
+        # The wrapped step calls only apply the moves that were already chosen
+        for i, (move, completion_text) in zip(missing, moves):
+            sae_envs[i].cache_move(move, completion_text)
+            sae_envs[i].pending_move = move
+
+        return super().step_wait()
+
+    def close(self):
+        super().close()
+        self.completer.close()
+
+def set_thread_event_loop():
+    """
+    Gives the calling thread its own event loop. The sync goodfire client runs every request
+    on the current thread's event loop, which only the main thread has by default.
+    """
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+class ThreadedVecEnv(DummyVecEnv):
+    """
+    Steps every environment on its own thread of one process. TicTacToeSAE spends nearly all
+    of a step waiting for the API, so the threads overlap the requests and a step of the whole
+    batch takes about one round trip. Unlike SubprocVecEnv, the environments can share one
+    backend, one MoveChecker and one rate limiter, and nothing is pickled between processes.
+
+    env_fns should give every environment its own teacher and wrappers, e.g. a Monitor, which
+    behave as they do in a DummyVecEnv. Each environment draws from its own random generators,
+    seed gives them consecutive seeds.
+
+    Args:
+        env_fns: Functions creating the environments
+        max_workers: Threads stepping the environments, one per environment by default
+    """
+
+    def __init__(self, env_fns, max_workers=None):
+        super().__init__(env_fns)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or self.num_envs, thread_name_prefix='env', initializer=set_thread_event_loop)
+
+    def _step_env(self, env_idx):
+        obs, reward, terminated, truncated, info = self.envs[env_idx].step(self.actions[env_idx])
+        info["TimeLimit.truncated"] = truncated and not terminated
+
+        # Reset on the same thread, like DummyVecEnv does after the step
+        reset_info = None
+        if terminated or truncated:
+            info["terminal_observation"] = obs
+            obs, reset_info = self.envs[env_idx].reset()
+            
+            # Tracing data is kept per thread, what the reset recorded belongs to this env
+            if tracer.enabled:
+                trace = Tracer(enabled=True)
+                trace.merge(info.get('trace', {'timings': {}, 'counters': {}}))
+                trace.merge(tracer.drain())
+                info['trace'] = trace.drain()
+        return obs, reward, terminated or truncated, info, reset_info
+
+    def step_wait(self):
+        results = list(self.executor.map(self._step_env, range(self.num_envs)))
+        for env_idx, (obs, reward, done, info, reset_info) in enumerate(results):
+            self.buf_rews[env_idx] = reward
+            self.buf_dones[env_idx] = done
+            self.buf_infos[env_idx] = info
+            if reset_info is not None:
+                self.reset_infos[env_idx] = reset_info
+            self._save_obs(env_idx, obs)
+        return (self._obs_from_buf(), np.copy(self.buf_rews), np.copy(self.buf_dones), deepcopy(self.buf_infos))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        super().close()
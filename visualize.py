@@ -1,7 +1,10 @@
+import os
+import sys
 import tkinter as tk
 from tkinter import ttk
-import pickle
 from functools import partial
+from feature_index import FeatureIndex, update_index, default_index_path
+from recorder import convert_activations_pickle
 
 # Constants for window size
 WINDOW_WIDTH = 1000
@@ -9,33 +12,30 @@ WINDOW_HEIGHT = 650
 BOARD_SIZE = 300
 FEATURE_WIDTH = 400
 
-# Load the pickle dump
-with open('output/features.pkl', 'rb') as f:
-    data = pickle.load(f)
-    print(f"Loaded {len(data)} board states")
+# Step log to visualize, the old features.pkl dump is converted to a log once if there is none
+if len(sys.argv) > 1:
+    log_directory = sys.argv[1]
+elif os.path.exists('output/step_log'):
+    log_directory = 'output/step_log'
+else:
+    log_directory = 'output/features_log'
+    if not os.path.exists(log_directory):
+        convert_activations_pickle('output/features.pkl', log_directory)
+
+# Only steps recorded since the last run are aggregated
+update_index(log_directory)
+index = FeatureIndex(default_index_path(log_directory))
 
 # Prepare the list of board states
-board_states_list = list(data.keys())
+board_states_list = index.board_states()
+print(f"Loaded {len(board_states_list)} board states")
 current_board_index = 0
 board_values = [''] * 9
 
-# Function to calculate the mean of feature values for a given board state
+# Function to get the mean of feature values for a given board state
 def get_mean_features(board_state):
-    if board_state in data:
-        actions = data[board_state]
-        feature_sums = {}
-        counts = {}
-        for action in actions:
-            for feature, value in action:
-                feature_name = feature.label
-                feature_sums[feature_name] = feature_sums.get(feature_name, 0) + value
-                counts[feature_name] = counts.get(feature_name, 0) + 1
-        mean_features = {k: feature_sums[k] / counts[k] for k in feature_sums}
-        # Get the top 5 features by absolute mean value
-        top_features = sorted(mean_features.items(), key=lambda x: -abs(x[1]))[:5]
-        return top_features
-    else:
-        return []
+    # Get the top 5 features by absolute mean value
+    return index.top_features(board_state, 5)
     
 def translate_board(board_state):
     for i, cell in enumerate(board_state):